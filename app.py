@@ -1,4 +1,5 @@
 import argparse
+import base64
 import datetime
 import json
 import logging
@@ -12,7 +13,7 @@ from functools import wraps
 from constants import *
 
 import cherrypy
-from flask import (Flask, flash, jsonify, make_response, redirect,
+from flask import (Flask, Response, flash, jsonify, make_response, redirect,
                    render_template, request, send_file, send_from_directory,
                    url_for)
 from flask_paginate import Pagination, get_page_parameter
@@ -102,41 +103,90 @@ def logout():
     flash("Logged out of admin mode!", "is-success")
     return resp
 
+def versioned_state(topic, build):
+    """Respond with the JSON of a state topic, tagged with its version.
+
+    Answers If-None-Match with 304, and with ?since=<version>&wait=<seconds> holds the
+    request until the topic moves past that version (long polling). The version is
+    returned in the X-State-Version header.
+    """
+    since = request.args.get("since", type=int)
+    wait = min(request.args.get("wait", 0, type=float), LONG_POLL_MAX_WAIT)
+    if since is not None and wait > 0:
+        k.state.wait(since, wait, topic)
+    version, data = k.state.get_json(topic, build)
+    etag = "%s-%s-%d" % (topic, k.state.epoch, version)
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        response = make_response(data)
+    response.set_etag(etag)
+    response.headers["X-State-Version"] = str(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 @app.route("/nowplaying")
 def nowplaying():
     try: 
-        if len(k.queue) >= 1:
-            next_song = k.queue[0]["title"]
-            next_user = k.queue[0]["user"]
-        else:
-            next_song = None
-            next_user = None
-        rc = {
-            "now_playing": k.now_playing,
-            "now_playing_user": k.now_playing_user,
-            "up_next": next_song,
-            "next_user": next_user,
-            "is_paused": k.is_paused,
-            "transpose_value": k.now_playing_transpose,
-        }
-        return json.dumps(rc)
+        return versioned_state("nowplaying", k.get_now_playing)
     except (Exception) as e:
         logger.error("Problem loading /nowplaying, pikaraoke may still be starting up: " + str(e))
         return ""
 
 
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+@app.route("/stream")
+def stream():
+    """Server-sent events: a "nowplaying" and a "queue" event whenever that state changes.
+
+    Clients without EventSource support keep polling /nowplaying and /get_queue, and so
+    do clients turned away with a 503 once MAX_STREAMS streams are open.
+    """
+    if not stream_slots.acquire(blocking=False):
+        return Response("Too many open streams", status=503, headers={"Retry-After": "60"})
+
+    def events():
+        yield "retry: %d\n\n" % (SSE_RETRY * 1000)
+        version = None
+        sent = {}
+        while True:
+            version = k.state.wait(version, timeout=SSE_KEEPALIVE)
+            if not k.running:
+                return
+            pushed = False
+            for event, build in (("nowplaying", k.get_now_playing), ("queue", k.queue.to_list)):
+                event_version, data = k.state.get_json(event, build)
+                if sent.get(event) != event_version:
+                    sent[event] = event_version
+                    pushed = True
+                    yield "event: %s\ndata: %s\n\n" % (event, data)
+            if not pushed:
+                # comment line, keeps proxies from closing the connection and lets us
+                # notice clients that went away
+                yield ": keepalive\n\n"
+
+    response = Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # called when the client goes away, whether or not any event was sent
+    response.call_on_close(stream_slots.release)
+    return response
+
+
 @app.route("/queue")
 def queue():
     return render_template(
-        "queue.html", queue=k.queue, site_title=site_name, title="Queue", admin=is_admin()
+        "queue.html", queue=k.queue.to_list(), site_title=site_name, title="Queue", admin=is_admin()
     )
 
 @app.route("/get_queue")
 def get_queue():
-    if len(k.queue) >= 1:
-        return json.dumps(k.queue)
-    else:
-        return json.dumps([])
+    return versioned_state("queue", k.queue.to_list)
 
 @app.route("/queue/addrandom", methods=["GET"])
 def add_random():
@@ -157,22 +207,25 @@ def queue_edit():
         flash("Cleared the queue!", "is-warning")
         return redirect(url_for("queue"))
     else:
-        song = request.args["song"]
-        song = unquote(song)
+        entry = k.queue.get(request.args.get("id", type=int))
+        if entry is None:
+            flash("Song is no longer in the queue", "is-warning")
+            return redirect(url_for("queue"))
+        song = entry["title"]
         if action == "down":
-            result = k.queue_edit(song, "down")
+            result = k.queue_edit(entry["id"], "down")
             if result:
                 flash("Moved down in queue: " + song, "is-success")
             else:
                 flash("Error moving down in queue: " + song, "is-danger")
         elif action == "up":
-            result = k.queue_edit(song, "up")
+            result = k.queue_edit(entry["id"], "up")
             if result:
                 flash("Moved up in queue: " + song, "is-success")
             else:
                 flash("Error moving up in queue: " + song, "is-danger")
         elif action == "delete":
-            result = k.queue_edit(song, "delete")
+            result = k.queue_edit(entry["id"], "delete")
             if result:
                 flash("Deleted from queue: " + song, "is-success")
             else:
@@ -277,18 +330,73 @@ def search():
         "search.html",
         site_title=site_name,
         title="Search",
-        songs=k.available_songs,
         search_results=search_results,
         search_string=search_string,
     )
 
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+
+@app.route("/api/songs")
+def api_songs():
+    """A page of the song library as JSON.
+
+    Query parameters: q (search), letter, sort=date, limit (max 500), fields (comma
+    separated: path, title, date) and cursor, the "next" value of the previous page.
+    "total" is null for searches, which stop ranking once the page is full.
+    """
+    q = request.args.get('q')
+    letter = request.args.get('letter')
+    by_date = request.args.get('sort') == "date"
+    limit = min(max(request.args.get('limit', type=int, default=50), 1), 500)
+    fields = request.args.get('fields', "path,title").split(",")
+    try:
+        cursor = decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+        if q:
+            # search results are ranked by relevance, so their cursor is a plain offset
+            offset = int(cursor or 0)
+            if offset < 0:
+                raise ValueError
+            # one match more than the page tells whether there is a next one
+            matches = k.search_available_songs(q, limit=offset + limit + 1)
+            page = matches[offset:offset + limit]
+            total = None
+            next_cursor = encode_cursor(offset + limit) if len(matches) > offset + limit else None
+        else:
+            view = k.catalog.get_songs(letter.lower() if letter else None, by_date)
+            page = view.page(tuple(cursor) if cursor is not None else None, limit + 1)
+            total = len(view)
+            next_cursor = encode_cursor(view.key(page[limit - 1])) if len(page) > limit else None
+            page = page[:limit]
+    except (ValueError, TypeError):
+        return make_response(json.dumps({"error": "Invalid cursor"}), 400)
+
+    songs = []
+    for each in page:
+        song = {}
+        if "path" in fields:
+            song["path"] = each.path
+        if "title" in fields:
+            song["title"] = each.title
+        if "date" in fields:
+            song["date"] = each.ctime
+        songs.append(song)
+    response = app.response_class(
+        response=json.dumps({"songs": songs, "total": total, "next": next_cursor}),
+        mimetype='application/json'
+    )
+    return response
+
 @app.route("/autocomplete")
 def autocomplete():
-    q = request.args.get('q').lower()
+    q = request.args.get('q', '')
+    limit = request.args.get('limit', type=int, default=50)
     result = []
-    for each in k.available_songs:
-        if q in each.lower():
-            result.append({"path": each, "fileName": k.filename_from_path(each), "type": "autocomplete"})
+    for each in k.search_available_songs(q, limit):
+        result.append({"path": each.path, "fileName": each.title, "type": "autocomplete"})
     response = app.response_class(
         response=json.dumps(result),
         mimetype='application/json'
@@ -303,35 +411,20 @@ def browse():
         search = True
     page = request.args.get(get_page_parameter(), type=int, default=1)
 
-    available_songs = k.available_songs
-
     letter = request.args.get('letter')
-   
     if (letter):
-        result = []
-        if (letter == "numeric"):
-            for song in available_songs:
-                f = k.filename_from_path(song)[0]
-                if (f.isnumeric()):
-                    result.append(song)
-        else: 
-            for song in available_songs:
-                f = k.filename_from_path(song).lower()
-                if (f.startswith(letter.lower())):
-                    result.append(song)
-        available_songs = result
+        letter = letter.lower()
 
     if "sort" in request.args and request.args["sort"] == "date":
-        songs = sorted(available_songs, key=lambda x: os.path.getctime(x))
-        songs.reverse()
+        songs = k.catalog.get_songs(letter, by_date=True).items
         sort_order = "Date"
     else:
-        songs = available_songs
+        songs = k.catalog.get_songs(letter).items
         sort_order = "Alphabetical"
-    
+
     results_per_page = 500
     pagination = Pagination(css_framework='bulma', page=page, total=len(songs), search=search, record_name='songs', per_page=results_per_page)
-    start_index = (page - 1) * (results_per_page - 1)
+    start_index = (page - 1) * results_per_page
     return render_template(
         "files.html",
         pagination=pagination,
@@ -339,7 +432,7 @@ def browse():
         site_title=site_name,
         letter=letter,
         title="Browse",
-        songs=songs[start_index:start_index + results_per_page],
+        songs=[song.path for song in songs[start_index:start_index + results_per_page]],
         admin=is_admin()
     )
 
@@ -354,6 +447,22 @@ def download():
     else:
         queue = False
 
+    # don't spend bandwidth and a spleeter run on a video we already have
+    youtube_id = k.get_youtube_id_from_url(song)
+    existing_song = k.get_downloaded_song(youtube_id) if youtube_id else None
+    if existing_song:
+        flash_message = "Song is already in the library: '%s'. " % filename_from_path(existing_song)
+        if queue:
+            if k.enqueue(existing_song, user):
+                flash_message += "Song was added to queue."
+            else:
+                flash_message += "Song is already in the queue."
+        flash(flash_message, "is-info")
+        return redirect(url_for("search"))
+    if youtube_id in k.downloading:
+        flash("Download already in progress: '" + song + "'.", "is-info")
+        return redirect(url_for("search"))
+
     # download in the background since this can take a few minutes
     t = threading.Thread(target=k.download_video, args=[song, queue, user])
     t.daemon = True
@@ -424,7 +533,7 @@ def edit_file():
                 # check if new_name already exist
                 file_extension = os.path.splitext(old_name)[1]
                 if os.path.isfile(
-                    os.path.join(k.download_path, new_name + file_extension)
+                    os.path.join(os.path.dirname(old_name), new_name + file_extension)
                 ):
                     flash(
                         "Error Renaming file: '%s' to '%s'. Filename already exists."
@@ -612,6 +721,13 @@ if __name__ == "__main__":
         default=default_dl_dir,
         required=False,
     )
+    parser.add_argument(
+        "--library-path",
+        action="append",
+        default=[],
+        help="Additional directory to serve songs from, e.g. a USB drive or NAS share. Can be given more than once. Downloads always go to the download path.",
+        required=False,
+    )
     parser.add_argument(
         "-y",
         "--youtubedl-path",
@@ -704,6 +820,43 @@ if __name__ == "__main__":
         help="Show overlay on top of video with pikaraoke QR code and IP",
         required=False,
     )
+    parser.add_argument(
+        "--library-db",
+        help="Path of the song library catalog database (default: %s)" % LIBRARY_DB_PATH,
+        default=LIBRARY_DB_PATH,
+        required=False,
+    )
+    parser.add_argument(
+        "--watch-library",
+        action="store_true",
+        help="Watch the library paths for added, removed and renamed songs (inotify, or polling where unavailable) instead of relying on manual refreshes",
+        required=False,
+    )
+    parser.add_argument(
+        "--persistent-vlc",
+        action="store_true",
+        help="Keep a single VLC instance running and switch songs through its playlist, instead of starting VLC for every song. VLC is only restarted if it crashes.",
+        required=False,
+    )
+    parser.add_argument(
+        "--prerender-transpose",
+        action="store_true",
+        help="Render transposed versions of the accompaniment in the background (librosa) and play those instead of shifting the pitch in real time. The keys requested most are rendered ahead of time for every song. Renders are kept in %s." % TRANSPOSE_CACHE_DIR,
+        required=False,
+    )
+    parser.add_argument(
+        "--multitrack",
+        action="store_true",
+        help="Store separated songs as a single .mkv with the accompaniment and the original vocal audio as two audio tracks, instead of two full copies of the video. Existing pairs can be converted with scripts/migrate_multitrack.py",
+        required=False,
+    )
+    parser.add_argument(
+        "--separation-workers",
+        help="Number of processes separating vocals from downloaded songs. Each one keeps its own copy of the separation model in memory (several hundred MB) once the first song is downloaded; long songs are split across them. (default: %s)"
+        % SEPARATION_WORKERS,
+        default=SEPARATION_WORKERS,
+        required=False,
+    )
     parser.add_argument(
         "--admin-password",
         help="Administrator password, for locking down certain features of the web UI such as queue editing, player controls, song editing, and system shutdown. If unspecified, everyone is an admin.",
@@ -750,6 +903,7 @@ if __name__ == "__main__":
     k = karaoke.Karaoke(
         port=args.port,
         download_path=dl_path,
+        library_paths=[os.path.expanduser(path) for path in args.library_path],
         youtubedl_path=args.youtubedl_path,
         splash_delay=args.splash_delay,
         volume=args.volume,
@@ -762,6 +916,12 @@ if __name__ == "__main__":
         vlc_port=args.vlc_port,
         logo_path=args.logo_path,
         show_overlay=args.show_overlay,
+        library_db_path=args.library_db,
+        watch_library=args.watch_library,
+        persistent_vlc=args.persistent_vlc,
+        prerender_transpose=args.prerender_transpose,
+        multitrack=args.multitrack,
+        separation_workers=args.separation_workers,
         logger=logger
     )
 
@@ -779,6 +939,9 @@ if __name__ == "__main__":
                 "log.screen": True,
                 "server.socket_port": int(args.port),
                 "server.socket_host": k.ip,
+                # every open /stream holds a worker thread for as long as the page is open,
+                # at most MAX_STREAMS of them
+                "server.thread_pool": SERVER_THREAD_POOL,
             }
         )
         cherrypy.engine.start()
@@ -4,3 +4,18 @@ ACCOMPANIMENT_SUFFIX = '_accompaniment'
 VOCAL_SUFFIX = '_vocal'
 
 TMP_DIR = '~/spleeter'
+
+LIBRARY_DB_PATH = '~/.pikaraoke/library.db'
+
+SSE_KEEPALIVE = 15  # in seconds
+SSE_RETRY = 3  # in seconds
+LONG_POLL_MAX_WAIT = 30  # in seconds
+POSITION_TOLERANCE = 2  # in seconds, before clients get a corrected playback position
+SERVER_THREAD_POOL = 100
+# every open /stream holds a server thread, past this many clients fall back to long polling
+# so that the rest of the pool stays free for long polls and ordinary requests
+MAX_STREAMS = 40
+EXTRACTION_CACHE_BYTES = 512 * 1024 * 1024  # extracted .zip karaoke packs kept on disk
+TRANSPOSE_CACHE_DIR = '~/.pikaraoke/transposed'
+TRANSPOSE_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # pre-rendered transposed audio kept on disk
+SEPARATION_WORKERS = 1  # each holds its own copy of the separation model in memory
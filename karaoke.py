@@ -4,19 +4,26 @@ import os
 import random
 import socket
 import subprocess
+import threading
 import time
 from constants import *
 import shutil
 
 from subprocess import check_output
-from pathlib import Path, PosixPath
 
-from spleeter.__main__ import separate
-from spleeter.audio import Codec, STFTBackend
 import qrcode
 
 from lib import vlcclient
 from lib.get_platform import get_platform
+from lib.library_watcher import LibraryWatcher
+from lib.pitch_cache import PitchCache
+from lib.prefetcher import Prefetcher
+from lib.separation_service import SeparationService
+from lib.normalize import normalize_key
+from lib.song_catalog import SongCatalog
+from lib.song_library import SONG_EXTENSIONS, SongLibrary, parse_song_file
+from lib.song_queue import SongQueue
+from lib.state_notifier import StateNotifier
 from urllib.parse import urlparse, parse_qsl
 
 if get_platform() != "windows":
@@ -28,18 +35,16 @@ class Karaoke:
     raspi_wifi_conf_file = "/etc/raspiwifi/raspiwifi.conf"
     raspi_wifi_config_installed = os.path.exists(raspi_wifi_conf_file)
 
-    queue = []
-    available_songs = []
     now_playing = None
     now_playing_filename = None
     now_playing_user = None
     now_playing_transpose = 0
     is_paused = True
+    published_position = None
     process = None
     qr_code_path = None
     base_path = os.path.dirname(__file__)
     volume_offset = 0
-    loop_interval = 500  # in milliseconds
     default_logo_path = os.path.join(base_path, "logo.png")
     playing_type = ACCOMPANIMENT_SUFFIX
 
@@ -47,6 +52,7 @@ class Karaoke:
             self,
             port=5000,
             download_path="/usr/lib/pikaraoke/songs",
+            library_paths=None,
             hide_ip=False,
             hide_raspiwifi_instructions=False,
             hide_splash_screen=False,
@@ -62,6 +68,12 @@ class Karaoke:
             vlc_port=None,
             logo_path=None,
             show_overlay=False,
+            library_db_path=LIBRARY_DB_PATH,
+            watch_library=False,
+            persistent_vlc=False,
+            prerender_transpose=False,
+            multitrack=False,
+            separation_workers=SEPARATION_WORKERS,
             logger=None
     ):
 
@@ -72,6 +84,7 @@ class Karaoke:
         self.hide_splash_screen = hide_splash_screen
         self.omxplayer_adev = omxplayer_adev
         self.download_path = download_path
+        self.library_paths = library_paths or []
         self.dual_screen = dual_screen
         self.high_quality = high_quality
         self.splash_delay = int(splash_delay)
@@ -81,6 +94,12 @@ class Karaoke:
         self.vlc_port = vlc_port
         self.logo_path = self.default_logo_path if logo_path == None else logo_path
         self.show_overlay = show_overlay
+        self.library_db_path = library_db_path
+        self.watch_library = watch_library
+        self.persistent_vlc = persistent_vlc
+        self.prerender_transpose = prerender_transpose
+        self.multitrack = multitrack
+        self.separation_workers = int(separation_workers)
 
         # other initializations
         self.platform = get_platform()
@@ -100,12 +119,19 @@ class Karaoke:
     dual screen: %s
     high quality video: %s
     download path: %s
+    library paths: %s
     default volume: %s
     youtube-dl path: %s
     logo path: %s
     VLC path: %s
     VLC port: %s
-    show overlay: %s"""
+    show overlay: %s
+    library db path: %s
+    watch library: %s
+    persistent VLC: %s
+    prerender transpose: %s
+    multi-track songs: %s
+    separation workers: %s"""
             % (
                 self.port,
                 self.hide_ip,
@@ -116,12 +142,19 @@ class Karaoke:
                 self.dual_screen,
                 self.high_quality,
                 self.download_path,
+                self.library_paths,
                 self.volume_offset,
                 self.youtubedl_path,
                 self.logo_path,
                 self.vlc_path,
                 self.vlc_port,
-                self.show_overlay
+                self.show_overlay,
+                self.library_db_path,
+                self.watch_library,
+                self.persistent_vlc,
+                self.prerender_transpose,
+                self.multitrack,
+                self.separation_workers
             )
         )
 
@@ -145,8 +178,40 @@ class Karaoke:
 
         self.url = "http://%s:%s" % (self.ip, self.port)
 
-        # get songs from download_path
-        self.get_available_songs()
+        # bumped on every change to the queue or the player state, /stream pushes on it
+        self.state = StateNotifier()
+        self.queue = SongQueue(on_change=self.queue_changed)
+        self.pitch_cache = None
+        if self.prerender_transpose:
+            self.pitch_cache = PitchCache(
+                os.path.expanduser(TRANSPOSE_CACHE_DIR), TRANSPOSE_CACHE_BYTES, logger=self.logger
+            )
+        # keeps the separation model loaded between downloads, away from the web server
+        self.separation_service = SeparationService(workers=self.separation_workers, logger=self.logger)
+        # gets the next song ready while the current one plays
+        self.prefetcher = Prefetcher(self.queue.peek, self.prefetch_song, logger=self.logger)
+        # the player loop sleeps on this until a song is queued, skipped or ends
+        self.player_condition = threading.Condition()
+        self.player_woken = False
+        # cleared by stop(), which also ends the event streams
+        self.running = True
+
+        # serve the songs cataloged by the last session right away, then reconcile the
+        # catalog with the library roots in the background
+        roots = [self.download_path] + self.library_paths
+        self.library = SongLibrary(roots, db_path=self.library_db_path, logger=self.logger)
+        self.available_songs_lock = threading.RLock()
+        self.catalog = SongCatalog()
+        self.catalog.update(self.library.get_songs(), [])
+        self.catalog.update_files(self.library.get_youtube_files(), [])
+        self.downloading = set()
+        self.library_watcher = None
+        if self.watch_library:
+            self.library_watcher = LibraryWatcher(self.library.roots, self.get_available_songs, logger=self.logger)
+            self.library_watcher.start()
+        t = threading.Thread(target=self.get_available_songs)
+        t.daemon = True
+        t.start()
 
         self.get_youtubedl_version()
 
@@ -156,9 +221,9 @@ class Karaoke:
         self.generate_qr_code()
 
         if self.show_overlay:
-            self.vlcclient = vlcclient.VLCClient(port=self.vlc_port, path=self.vlc_path, qrcode=self.qr_code_path, url=self.url, logger=self.logger)
+            self.vlcclient = vlcclient.VLCClient(port=self.vlc_port, path=self.vlc_path, qrcode=self.qr_code_path, url=self.url, on_exit=self.wake_player, on_position=self.playback_status, persistent=self.persistent_vlc, logger=self.logger)
         else:
-            self.vlcclient = vlcclient.VLCClient(port=self.vlc_port, path=self.vlc_path, logger=self.logger)
+            self.vlcclient = vlcclient.VLCClient(port=self.vlc_port, path=self.vlc_path, on_exit=self.wake_player, on_position=self.playback_status, persistent=self.persistent_vlc, logger=self.logger)
 
 
     # Other ip-getting methods are unreliable and sometimes return 127.0.0.1
@@ -270,6 +335,18 @@ class Karaoke:
         return self.get_search_results(songTitle + " karaoke")
 
     def download_video(self, video_url, enqueue=False, user="Pikaraoke"):
+        youtube_id = self.get_youtube_id_from_url(video_url)
+        with self.available_songs_lock:
+            if youtube_id in self.downloading:
+                self.logger.warning("Video is already being downloaded: " + video_url)
+                return 0
+            self.downloading.add(youtube_id)
+        try:
+            return self.download_new_video(video_url, youtube_id, enqueue, user)
+        finally:
+            self.downloading.discard(youtube_id)
+
+    def download_new_video(self, video_url, youtube_id, enqueue=False, user="Pikaraoke"):
         self.logger.info("Downloading video: " + video_url)
         dl_path = self.download_path + "%(title)s---%(id)s.%(ext)s"
         file_quality = (
@@ -286,9 +363,8 @@ class Karaoke:
         if rc == 0:
             self.logger.debug("Song successfully downloaded: " + video_url)
 
-            y = self.get_youtube_id_from_url(video_url)
-            s = self.find_song_by_youtube_id(y)
-            item = self.post_process_video(s)
+            s = self.find_song_by_youtube_id(youtube_id)
+            item = self.post_process_video(s) if s else None
 
             if item:
                 self.get_available_songs()
@@ -296,14 +372,23 @@ class Karaoke:
                     self.enqueue(item, user)
                 else:
                     self.logger.error("Error queueing song: " + video_url)
+            else:
+                # the original stays on disk, downloading the video again retries the split
+                self.logger.error("Error processing song, not queued: " + video_url)
         else:
             self.logger.error("Error downloading song: " + video_url)
         return rc
 
     def post_process_video(self, file_path):
+        """Split the vocals off a downloaded song. Returns the path of the accompaniment
+        version, or None if the song could not be processed (the original is left as is)."""
         base, ext = os.path.splitext(file_path)
-        accompaniment_path = base + ACCOMPANIMENT_SUFFIX + ext
         vocal_path = base + VOCAL_SUFFIX + ext
+        if self.multitrack:
+            # Matroska, since mp4 can't hold every audio codec the original may use
+            accompaniment_path = base + ACCOMPANIMENT_SUFFIX + ".mkv"
+        else:
+            accompaniment_path = base + ACCOMPANIMENT_SUFFIX + ext
 
         tmp_path = os.path.expanduser(TMP_DIR)
         tmp_path = os.path.join(tmp_path, str(random.randint(1, 10000000)))
@@ -314,63 +399,81 @@ class Karaoke:
             print("Creating tmp path: " + tmp_path)
             os.makedirs(tmp_path)
 
-        split_result = 0
-        # Split vocal and accompaniment
-        # separate(files=[Path(file_path)],output_path=Path(tmp_dir), filename_format="{filename}_{instrument}.{codec}")
-        cmd = ["spleeter", "separate", "-o", tmp_path, "-f", "{instrument}.{codec}", file_path]
-        self.logger.info(str(cmd))
-        split_result = subprocess.call(cmd)
-
-        # try:
-        #     self.seperate_audio(file_path, tmp_path)
-        # except Exception as e:
-        #     self.logger.error('Split audio failed due to %s' % e)
-        #     split_result = 1
-
-        if split_result == 0:
-            # Split video and audio
-            s_cmd = ["ffmpeg", "-i", file_path, "-an", "-c", "copy", f"{tmp_path}/video.mp4"]
-            split_rs = subprocess.call(s_cmd)
-
-            # Merge video and accompaniment
-            m_cmd = ["ffmpeg", "-i", f"{tmp_path}/video.mp4", "-i", f"{tmp_path}/accompaniment.wav", "-c:v", "copy", "-c:a", "aac", accompaniment_path]
-            merge_rs = subprocess.call(m_cmd)
+        start = time.time()
+        try:
+            # Split vocal and accompaniment
+            if not self.separation_service.separate(file_path, tmp_path):
+                return None
+            separated = time.time()
+
+            # One pass: the video stream straight from the original, the audio from the
+            # separated stem. Written to the tmp path first, so a failed mux leaves nothing behind
+            partial_path = tmp_path + "muxed" + os.path.splitext(accompaniment_path)[1]
+            cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", file_path, "-i", tmp_path + "accompaniment.wav"]
+            if self.multitrack:
+                # the accompaniment as first and the original audio as second audio track
+                cmd += [
+                    "-map", "0:v:0", "-map", "1:a:0", "-map", "0:a:0",
+                    "-c:v", "copy", "-c:a:0", "aac", "-c:a:1", "copy",
+                    "-metadata:s:a:0", "title=Accompaniment", "-metadata:s:a:1", "title=Vocal",
+                    "-disposition:a:0", "default", "-disposition:a:1", "0",
+                ]
+            else:
+                cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac"]
+            if not self.run_stage("mux", cmd + [partial_path]):
+                return None
+            shutil.move(partial_path, accompaniment_path)
 
-            os.rename(file_path, vocal_path)
-            self.logger.info('Spleeter song succeed!')
+            if self.multitrack:
+                os.remove(file_path)
+            else:
+                os.rename(file_path, vocal_path)
+        finally:
             shutil.rmtree(tmp_path, ignore_errors=True)
-        return accompaniment_path
 
-    def seperate_audio(self, file_path, output_path):
-        separate(
-            deprecated_files=None,
-            files=[PosixPath(os.path.abspath(file_path))],
-            adapter='spleeter.audio.ffmpeg.FFMPEGProcessAudioAdapter',
-            bitrate='128k',
-            codec=Codec.WAV,
-            duration=600.0,
-            offset=0.0,
-            output_path=PosixPath(os.path.abspath(output_path)),
-            stft_backend=STFTBackend.AUTO,
-            filename_format="{instrument}.{codec}",
-            params_filename='spleeter:2stems',
-            mwf=False,
-            verbose=False
+        self.logger.info(
+            "Spleeter song succeed in %.2fs (separate: %.2fs, mux: %.2fs): %s"
+            % (time.time() - start, separated - start, time.time() - separated, accompaniment_path)
         )
+        return accompaniment_path
 
-    def get_available_songs(self):
-        self.logger.info("Fetching available songs in: " + self.download_path)
-        types = ['.mp4', '.mp3', '.zip', '.mkv', '.avi', '.webm', '.mov']
-        files_grabbed = []
-        P = Path(self.download_path)
-        for file in P.rglob('*.*'):
-            base, ext = os.path.splitext(file.as_posix())
-            if ext.lower() in types and base.endswith(ACCOMPANIMENT_SUFFIX):
-                if os.path.isfile(file.as_posix()):
-                    self.logger.debug("adding song: " + file.name)
-                    files_grabbed.append(file.as_posix())
+    def run_stage(self, name, cmd):
+        """Run one external step of post-processing, logging its time and any error output."""
+        self.logger.info(str(cmd))
+        start = time.time()
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.logger.error("Could not run %s: %s" % (name, e))
+            return False
+        self.logger.debug("%s took %.2fs" % (name, time.time() - start))
+        if result.returncode != 0:
+            error = result.stderr.decode("utf-8", "replace").strip()[-1000:]
+            self.logger.error("%s failed with code %s: %s" % (name, result.returncode, error))
+            return False
+        return True
 
-        self.available_songs = sorted(files_grabbed, key=lambda f: str.lower(os.path.basename(f)))
+    def get_available_songs(self, dirs=None):
+        if dirs is None:
+            self.logger.info("Fetching available songs in: " + ", ".join(self.library.roots))
+        with self.available_songs_lock:
+            added, removed = self.library.refresh(dirs)
+            self.update_available_songs(added, removed)
+
+    def update_available_songs(self, added, removed):
+        """Apply added and removed library files to the song catalog."""
+        self.catalog.update_files(added, removed)
+        added = [f for f in added if parse_song_file(f)[3] == "accompaniment"]
+        removed = [f for f in removed if parse_song_file(f)[3] == "accompaniment"]
+        if not added and not removed:
+            return
+        self.logger.info("Library changed: %d songs added, %d removed" % (len(added), len(removed)))
+        with self.available_songs_lock:
+            self.catalog.update(self.library.get_songs(added), removed)
+
+    def search_available_songs(self, query, limit=50):
+        """Catalog records matching a search query, best matches first."""
+        return self.catalog.search(normalize_key(query), limit)
 
     def delete(self, song_path):
         self.logger.info("Deleting song: " + song_path)
@@ -396,11 +499,13 @@ class Karaoke:
         ext = os.path.splitext(song_path)
         if len(ext) == 2:
             new_file_name = new_name + ext[1]
-        os.rename(song_path, self.download_path + new_file_name)
+        # songs may live in any library root, so rename within the song's own directory
+        song_dir = os.path.dirname(song_path)
+        os.rename(song_path, os.path.join(song_dir, new_file_name))
         # if we have an associated cdg file, rename that too
         cdg_file = song_path.replace(ext[1], ".cdg")
         if (os.path.exists(cdg_file)):
-            os.rename(cdg_file, self.download_path + new_name + ".cdg")
+            os.rename(cdg_file, os.path.join(song_dir, new_name + ".cdg"))
         self.get_available_songs()
 
     def filename_from_path(self, file_path):
@@ -410,19 +515,31 @@ class Karaoke:
         return rc
 
     def find_song_by_youtube_id(self, youtube_id):
+        # make sure a file downloaded just now is cataloged
+        self.get_available_songs()
+        originals = [
+            f for f in self.catalog.get_youtube_files(youtube_id)
+            if parse_song_file(f)[3] == "" and parse_song_file(f)[2] in SONG_EXTENSIONS
+        ]
+        if originals:
+            return originals[0]
+
+        self.logger.error("New downloaded song not found: %s" % youtube_id)
+        return None
 
-        P = Path(self.download_path)
-        for file in P.rglob('*.*'):
-            if os.path.isfile(file.as_posix()) and youtube_id in file.as_posix():
-                return file.as_posix()
-
-        self.logger.error("New downloaded song not found: " + youtube_id)
+    def get_downloaded_song(self, youtube_id):
+        """The playable song already downloaded from the given video, if any."""
+        for f in self.catalog.get_youtube_files(youtube_id):
+            if parse_song_file(f)[3] == "accompaniment":
+                return f
         return None
 
     def get_youtube_id_from_url(self, url):
-        query = urlparse(url).query
-        query_dict = dict(parse_qsl(query))
-        youtube_id = query_dict['v']
+        parsed = urlparse(url)
+        query_dict = dict(parse_qsl(parsed.query))
+        youtube_id = query_dict.get('v')
+        if not youtube_id and parsed.netloc.endswith("youtu.be"):
+            youtube_id = parsed.path.strip("/")
         if youtube_id:
             return youtube_id
         else:
@@ -434,98 +551,117 @@ class Karaoke:
         if self.vlcclient:
             self.vlcclient.kill()
 
-    def play_file(self, file_path, semitones=0):
+    def play_file(self, file_path):
         self.now_playing = self.filename_from_path(file_path)
         self.now_playing_filename = file_path
 
         self.logger.info("Playing video in VLC: " + self.now_playing)
-        if semitones == 0:
-            self.vlcclient.play_file(file_path, playing_type=self.playing_type)
-        else:
-            self.vlcclient.play_file_transpose(file_path, semitones)
+        self.vlcclient.play_file(file_path, playing_type=self.playing_type)
+        if self.pitch_cache:
+            self.pitch_cache.prerender(file_path)
 
         self.is_paused = False
+        self.state.notify("nowplaying")
 
     def transpose_current(self, semitones):
         self.logger.info("Transposing song by %s semitones" % semitones)
+        if self.pitch_cache:
+            self.pitch_cache.record_use(semitones)
+        self.play_transposed(semitones)
+
+    def play_transposed(self, semitones):
+        """Restart the current song at its position, in `self.playing_type` and shifted by
+        `semitones`."""
+        file_path = self.now_playing_filename
+        # carry on where the singer is instead of starting over
+        try:
+            start_time = int(self.vlcclient.get_position())
+        except Exception:
+            start_time = 0
+        audio_path = None
+        if self.pitch_cache and semitones:
+            # renders are of the accompaniment, the vocal version is shifted in real time
+            if self.playing_type == ACCOMPANIMENT_SUFFIX:
+                audio_path = self.pitch_cache.get(file_path, semitones)
+                if audio_path is None:
+                    # shift in real time this once, the render is there next time
+                    self.pitch_cache.request(file_path, semitones)
         self.now_playing_transpose = semitones
-        self.play_file(self.now_playing_filename, semitones)
+        self.vlcclient.play_file_transpose(file_path, semitones, start_time, audio_path, self.playing_type)
+        self.is_paused = False
+        self.state.notify("nowplaying")
 
     def is_file_playing(self):
         if self.vlcclient != None and self.vlcclient.is_running():
             return True
         else:
-            self.now_playing = None
+            if self.now_playing != None:
+                self.now_playing = None
+                self.state.notify("nowplaying")
             return False
 
     def is_song_in_queue(self, song_path):
-        for each in self.queue:
-            if each["file"] == song_path:
-                return True
-        return False
+        return song_path in self.queue
 
     def enqueue(self, song_path, user="Pikaraoke"):
-        if self.is_song_in_queue(song_path):
+        if self.queue.append(song_path, self.filename_from_path(song_path), user) is None:
             self.logger.warn("Song is already in queue, will not add: " + song_path)
             return False
         else:
             self.logger.info("'%s' is adding song to queue: %s" % (user, song_path))
-            self.queue.append({"user": user, "file": song_path, "title": self.filename_from_path(song_path)})
             return True
 
     def queue_add_random(self, amount):
         self.logger.info("Adding %d random songs to queue" % amount)
-        songs = list(self.available_songs)  # make a copy
+        songs = self.catalog.songs
         if len(songs) == 0:
             self.logger.warn("No available songs!")
             return False
 
         selected_songs = random.sample(songs, amount)
         for song in selected_songs:
-            self.queue.append({"user": "Randomizer", "file": song, "title": self.filename_from_path(song)})
+            self.queue.append(song.path, song.title, "Randomizer", unique=False)
         return True
 
     def queue_clear(self):
         self.logger.info("Clearing queue!")
-        self.queue = []
+        self.queue.clear()
         self.skip()
 
-    def queue_edit(self, song_name, action):
-        index = 0
-        song = None
-        for each in self.queue:
-            if song_name in each["file"]:
-                song = each
-                break
-            else:
-                index += 1
+    def queue_changed(self):
+        # "up next" is part of the now playing state
+        self.state.notify("queue", "nowplaying")
+        self.wake_player()
+        self.prefetcher.notify()
+
+    def prefetch_song(self, song_path):
+        if self.vlcclient:
+            self.vlcclient.prefetch(song_path)
+
+    def queue_edit(self, entry_id, action):
+        song = self.queue.get(entry_id)
         if song == None:
-            self.logger.error("Song not found in queue: " + song["file"])
+            self.logger.error("Song not found in queue: %s" % entry_id)
             return False
         if action == "up":
-            if index < 1:
+            if not self.queue.move_up(entry_id):
                 self.logger.warn("Song is up next, can't bump up in queue: " + song["file"])
                 return False
             else:
                 self.logger.info("Bumping song up in queue: " + song["file"])
-                del self.queue[index]
-                self.queue.insert(index - 1, song)
                 return True
         elif action == "down":
-            if index == len(self.queue) - 1:
+            if not self.queue.move_down(entry_id):
                 self.logger.warn(
                     "Song is already last, can't bump down in queue: " + song["file"]
                 )
                 return False
             else:
                 self.logger.info("Bumping song down in queue: " + song["file"])
-                del self.queue[index]
-                self.queue.insert(index + 1, song)
                 return True
         elif action == "delete":
             self.logger.info("Deleting song from queue: " + song["file"])
-            del self.queue[index]
-            return True
+            return self.queue.remove(entry_id) is not None
         else:
             self.logger.error("Unrecognized direction: " + action)
             return False
@@ -533,9 +669,12 @@ class Karaoke:
     def skip(self):
         if self.is_file_playing():
             self.logger.info("Skipping: " + self.now_playing)
-            self.vlcclient.stop()
-            self.vlcclient.kill()
+            # reset first: stopping wakes the player loop, which may start the next song
+            # before this returns
             self.reset_now_playing()
+            self.vlcclient.stop()
+            if not self.vlcclient.persistent:
+                self.vlcclient.kill()
             return True
         else:
             self.logger.warning("Tried to skip, but no file is playing!")
@@ -550,6 +689,7 @@ class Karaoke:
                 self.vlcclient.play()
 
             self.is_paused = not self.is_paused
+            self.state.notify("nowplaying")
             return True
         else:
             self.logger.warning("Tried to pause, but no file is playing!")
@@ -574,6 +714,7 @@ class Karaoke:
     def fast_forward(self):
         if self.is_file_playing():
             self.vlcclient.fast_forward()
+            self.state.notify("nowplaying")
             return True
         else:
             self.logger.warning("Tried to fast forward 7 seconds, but no file is playing!")
@@ -582,6 +723,7 @@ class Karaoke:
     def fast_backward(self):
         if self.is_file_playing():
             self.vlcclient.fast_backward()
+            self.state.notify("nowplaying")
             return True
         else:
             self.logger.warning("Tried to fast backward 7 seconds, but no file is playing!")
@@ -591,12 +733,19 @@ class Karaoke:
         self.logger.info(f'{self.playing_type} to {playing_type}')
         if self.playing_type != playing_type:
             self.playing_type = playing_type
-            self.vlcclient.switch_vocals_accompaniment()
+            if (self.now_playing_transpose or self.vlcclient.track_multitrack) and self.is_file_playing():
+                # restarted where it is in the other version: the key carries over, a
+                # pre-rendered accompaniment isn't played over the vocals, and a multi-track
+                # file is played on its other audio track (--audio-track, by index)
+                self.play_transposed(self.now_playing_transpose)
+            else:
+                self.vlcclient.switch_vocals_accompaniment()
 
     def restart(self):
         if self.is_file_playing():
             self.vlcclient.restart()
             self.is_paused = False
+            self.state.notify("nowplaying")
             return True
         else:
             self.logger.warning("Tried to restart, but no file is playing!")
@@ -604,9 +753,42 @@ class Karaoke:
 
     def stop(self):
         self.running = False
-
-    def handle_run_loop(self):
-        time.sleep(self.loop_interval / 1000)
+        self.wake_player()
+        # wakes the event streams, so they see the player is gone and end
+        self.state.notify()
+        self.prefetcher.stop()
+        self.separation_service.stop()
+        if self.pitch_cache:
+            self.pitch_cache.close()
+        if self.vlcclient and self.vlcclient.persistent:
+            self.vlcclient.kill()
+        if self.library_watcher:
+            self.library_watcher.stop()
+
+    def playback_status(self, state):
+        """Status sample from the playback supervisor. Keeps is_paused in sync with VLC,
+        which can be paused from its own window or hotkeys too, and republishes the now
+        playing state when the position clients extrapolate is off."""
+        if self.now_playing == None:
+            return
+        is_paused = state["state"] == "paused"
+        if is_paused != self.is_paused:
+            self.is_paused = is_paused
+            self.state.notify("nowplaying")
+            return
+        if self.published_position == None:
+            self.state.notify("nowplaying")
+            return
+        expected, published_at = self.published_position
+        if not is_paused:
+            expected += time.time() - published_at
+        if abs(self.vlcclient.get_position() - expected) > POSITION_TOLERANCE:
+            self.state.notify("nowplaying")
+
+    def wake_player(self):
+        with self.player_condition:
+            self.player_woken = True
+            self.player_condition.notify()
 
     def reset_now_playing(self):
         self.now_playing = None
@@ -614,26 +796,52 @@ class Karaoke:
         self.now_playing_user = None
         self.is_paused = True
         self.now_playing_transpose = 0
+        self.published_position = None
+        self.state.notify("nowplaying")
+
+    def get_now_playing(self):
+        up_next = self.queue.peek()
+        rc = {
+            "now_playing": self.now_playing,
+            "now_playing_user": self.now_playing_user,
+            "up_next": up_next["title"] if up_next else None,
+            "next_user": up_next["user"] if up_next else None,
+            "is_paused": self.is_paused,
+            "transpose_value": self.now_playing_transpose,
+            "position": None,
+            "duration": None,
+            "position_time": None,
+        }
+        if self.now_playing != None and self.vlcclient and self.vlcclient.clock:
+            # clients advance the position themselves while playing, the state is only
+            # republished when that extrapolation goes wrong (see playback_status)
+            position = self.vlcclient.get_position()
+            now = time.time()
+            rc["position"] = round(position, 2)
+            rc["duration"] = self.vlcclient.get_duration()
+            rc["position_time"] = round(now, 2)
+            self.published_position = (position, now)
+        return rc
 
     def run(self):
         self.logger.info("Starting PiKaraoke!")
         self.running = True
         while self.running:
             try:
-                if not self.is_file_playing() and self.now_playing != None:
-                    self.reset_now_playing()
-                if len(self.queue) > 0:
-                    if not self.is_file_playing():
+                with self.player_condition:
+                    self.player_condition.wait_for(lambda: self.player_woken or not self.running)
+                    self.player_woken = False
+                # starting a song can fail, keep going until one plays or the queue is empty
+                while self.running and not self.is_file_playing():
+                    if self.now_playing_filename != None:
                         self.reset_now_playing()
-
-                        # i = 0
-                        # while i < (self.splash_delay * 1000):
-                        self.handle_run_loop()
-                            # i += self.loop_interval
-                        self.play_file(self.queue[0]["file"])
-                        self.now_playing_user = self.queue[0]["user"]
-                        self.queue.pop(0)
-                self.handle_run_loop()
+                    # the entry may have been edited meanwhile, so remove it by id
+                    song = self.queue.peek()
+                    if song is None:
+                        break
+                    self.now_playing_user = song["user"]
+                    self.play_file(song["file"])
+                    self.queue.remove(song["id"])
 
             except KeyboardInterrupt:
                 self.logger.warn("Keyboard interrupt: Exiting pikaraoke...")
@@ -0,0 +1,18 @@
+import hashlib
+import os
+
+# appended to a file or directory while it is written, renamed away once it is complete
+PARTIAL_SUFFIX = ".partial"
+
+
+def content_key(path):
+    """Short hash of a file's path, mtime and size: changes whenever the file does."""
+    st = os.stat(path)
+    return hashlib.sha1(("%s:%s:%s" % (path, st.st_mtime, st.st_size)).encode("utf-8")).hexdigest()[:16]
+
+
+def lower_priority():
+    """Run the calling process below the player, so background work never makes a playing
+    song stutter."""
+    if hasattr(os, "nice"):
+        os.nice(10)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+from lib.cache_files import PARTIAL_SUFFIX, content_key
+
+
+def dir_size(path):
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, name))
+            except OSError:
+                pass
+    return size
+
+
+class ExtractionCache:
+    """Extracted zip archives, one directory per archive, within a byte budget.
+
+    Entries are keyed by a hash of the archive path, mtime and size, so a changed archive
+    gets a new entry and an unchanged one is never decompressed twice. The least recently
+    used entries are evicted once the cache grows past `max_bytes`, except the `keep`
+    most recent ones, which may be playing or about to. Entries survive restarts: their
+    directory mtime records the last use.
+
+    An archive is extracted at most once at a time (concurrent callers for the same
+    archive wait for the first one), into a partial directory that is renamed into place
+    when complete, so readers never see a half extracted entry.
+    """
+
+    def __init__(self, root, max_bytes, keep=2, logger=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.logger = logger
+        self.lock = threading.Lock()
+        # [lock, callers using it] per archive being looked up, dropped by the last caller
+        self.key_locks = {}
+        self.entries = OrderedDict()
+        self.size = 0
+        self.load()
+
+    def load(self):
+        """Index the entries left by earlier runs, least recently used first."""
+        if not os.path.isdir(self.root):
+            return
+        found = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            found.append((entry.stat().st_mtime, entry.name, dir_size(entry.path)))
+        for mtime, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+
+    def get(self, zip_path):
+        """Directory holding the extracted contents of `zip_path`."""
+        key = content_key(zip_path)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                return self.get_entry(zip_path, key)
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.key_locks[key]
+
+    def get_entry(self, zip_path, key):
+        """The entry of `zip_path`, extracted if it isn't cached. Called holding the key's lock."""
+        entry_dir = os.path.join(self.root, key)
+        with self.lock:
+            hit = key in self.entries and os.path.isdir(entry_dir)
+            if hit:
+                self.entries.move_to_end(key)
+        if hit:
+            try:
+                os.utime(entry_dir)
+            except OSError:
+                pass
+            return entry_dir
+
+        start = time.time()
+        partial_dir = entry_dir + PARTIAL_SUFFIX
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            zip_ref.extractall(partial_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(partial_dir, entry_dir)
+        size = dir_size(entry_dir)
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.evict()
+        if self.logger:
+            self.logger.debug(
+                "Extracted %s (%d bytes) in %.2fs, cache holds %d bytes"
+                % (zip_path, size, time.time() - start, self.size)
+            )
+        return entry_dir
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > self.keep:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal ctypes binding to the Linux inotify API."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add_watch_fn = libc.inotify_add_watch
+        self.rm_watch_fn = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.add_watch_fn(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.rm_watch_fn(self.fd, wd)
+
+    def read(self, timeout):
+        """Wait up to `timeout` seconds and return a list of (wd, mask, name) events."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Reports the directories that changed under the library roots as they change.
+
+    inotify events are collected per directory and debounced: a batch is applied once the
+    tree has been quiet for `debounce` seconds (or `max_delay` seconds after the first
+    pending event), so a bulk copy of thousands of files results in a single `refresh`
+    call for the directories involved. Where inotify is not available, `refresh` is
+    called for all roots every `poll_interval` seconds instead.
+    """
+
+    def __init__(self, roots, refresh, debounce=2.0, max_delay=30.0, poll_interval=30, logger=None):
+        self.roots = roots
+        self.refresh = refresh
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.running = False
+        self.thread = None
+        self.inotify = None
+        self.watches = {}
+
+    def start(self):
+        self.running = True
+        try:
+            self.inotify = Inotify()
+            for root in self.roots:
+                self.watch_tree(root)
+            target = self.run_inotify
+            self.logger.info("Watching song library with inotify: " + ", ".join(self.roots))
+        except (OSError, AttributeError) as e:
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+            target = self.run_polling
+            self.logger.info(
+                "inotify unavailable (%s), polling song library every %ss" % (e, self.poll_interval)
+            )
+        self.thread = threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def watch_tree(self, dir_path):
+        stack = [dir_path]
+        while stack:
+            path = stack.pop()
+            try:
+                self.watches[self.inotify.add_watch(path)] = path
+                with os.scandir(path) as it:
+                    stack.extend(entry.path for entry in it if entry.is_dir())
+            except FileNotFoundError:
+                # removed again before we got to it, the parent's events cover that
+                continue
+
+    def run_inotify(self):
+        pending = set()
+        full_refresh = False
+        first_event = last_event = 0
+        while self.running:
+            try:
+                events = self.inotify.read(timeout=self.debounce / 2)
+            except OSError as e:
+                self.logger.error("Error reading inotify events: " + str(e))
+                break
+            now = time.time()
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    full_refresh = True
+                    continue
+                dir_path = self.watches.get(wd)
+                if dir_path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # the parent directory gets its own event for this
+                    continue
+                pending.add(dir_path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.watch_tree(os.path.join(dir_path, name))
+                    except OSError as e:
+                        self.logger.warning("Could not watch new directory %s: %s" % (name, e))
+            if events:
+                if not first_event:
+                    first_event = now
+                last_event = now
+
+            if (pending or full_refresh) and (
+                now - last_event >= self.debounce or now - first_event >= self.max_delay
+            ):
+                self.logger.debug("Applying library changes in %d directories" % len(pending))
+                try:
+                    self.refresh(None if full_refresh else pending)
+                except Exception as e:
+                    self.logger.error("Error updating song library: " + str(e))
+                pending = set()
+                full_refresh = False
+                first_event = last_event = 0
+
+        self.inotify.close()
+        self.logger.debug("Library watcher exits.")
+
+    def run_polling(self):
+        while self.running:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh(None)
+            except Exception as e:
+                self.logger.error("Error updating song library: " + str(e))
@@ -0,0 +1,25 @@
+import re
+import unicodedata
+
+from unidecode import unidecode
+from zhconv import convert
+
+# CJK ideographs, kana and hangul are kept as they are (ideographs in simplified form),
+# everything else is transliterated to ASCII
+NON_CJK_RUN = re.compile(r"[^\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+APOSTROPHES = re.compile(r"['`\u2018\u2019]")
+
+
+def normalize_key(text):
+    """Search key for a song title or a search query.
+
+    "Beyoncé - Halo" and "beyonce halo" share the key "beyonce halo", and titles in
+    traditional Chinese get the same key as their simplified spelling.
+    """
+    text = convert(text, "zh-cn")
+    text = NON_CJK_RUN.sub(lambda m: unidecode(m.group()), text)
+    text = APOSTROPHES.sub("", text.casefold())
+    text = "".join(
+        " " if unicodedata.category(c)[0] in "PSZC" else c for c in text
+    )
+    return " ".join(text.split())
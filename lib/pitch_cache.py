@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.cache_files import PARTIAL_SUFFIX, content_key, lower_priority
+
+RENDER_SUFFIX = ".flac"
+
+
+def render_pitch_shift(song_path, semitones, out_path):
+    """Render the audio of `song_path` shifted by `semitones` into `out_path` (FLAC).
+    Runs in a worker process."""
+    import librosa
+    import soundfile
+
+    y, sr = librosa.load(song_path, sr=None, mono=False)
+    shifted = librosa.effects.pitch_shift(y, sr=sr, n_steps=semitones)
+    partial_path = out_path + PARTIAL_SUFFIX
+    soundfile.write(partial_path, shifted.T, sr, format="FLAC")
+    os.replace(partial_path, out_path)
+    return os.path.getsize(out_path)
+
+
+class PitchCache:
+    """Pitch-shifted renders of song audio on disk, so a transpose needs no real-time DSP.
+
+    Renders run one at a time in a low-priority worker process. The semitone values
+    singers ask for most are rendered ahead of time for each song that starts playing,
+    any other value is rendered on its first request. Renders are evicted least recently
+    used first once they take more than `max_bytes`, except the `keep` most recent ones.
+    """
+
+    def __init__(self, root, max_bytes, prerender_count=2, default_keys=(-2, 2), keep=2, logger=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.prerender_count = prerender_count
+        self.keep = keep
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.usage = Counter({key: 0 for key in default_keys})
+        # spawned, not forked: the worker starts on the first render, in the middle of a
+        # multithreaded server whose locks and memory it must not inherit
+        self.executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn"), initializer=lower_priority
+        )
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.load()
+
+    def load(self):
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                os.remove(entry.path)
+            elif entry.name.endswith(RENDER_SUFFIX):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+    def name_of(self, song_path, semitones):
+        return "%s%+d%s" % (content_key(song_path), semitones, RENDER_SUFFIX)
+
+    def get(self, song_path, semitones):
+        """Path of the render of `song_path` at `semitones`, None if it isn't rendered yet."""
+        try:
+            name = self.name_of(song_path, semitones)
+        except OSError:
+            return None
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        path = os.path.join(self.root, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def request(self, song_path, semitones):
+        """Render `song_path` at `semitones` in the background, unless it is rendered already."""
+        if semitones == 0 or os.path.splitext(song_path)[1].lower() == ".zip":
+            # librosa can't read the audio of a zipped karaoke pack
+            return
+        try:
+            name = self.name_of(song_path, semitones)
+        except OSError as e:
+            self.logger.warning("Could not render transposed audio for %s: %s" % (song_path, e))
+            return
+        with self.lock:
+            if name in self.entries or name in self.pending:
+                return
+            future = self.executor.submit(
+                render_pitch_shift, song_path, semitones, os.path.join(self.root, name)
+            )
+            self.pending[name] = future
+        future.add_done_callback(lambda f: self.rendered(name, song_path, f))
+
+    def rendered(self, name, song_path, future):
+        with self.lock:
+            del self.pending[name]
+            try:
+                size = future.result()
+            except Exception as e:
+                self.logger.warning("Could not render transposed audio for %s: %s" % (song_path, e))
+                return
+            self.entries[name] = size
+            self.size += size
+            self.evict()
+        self.logger.debug("Rendered transposed audio: %s (%d bytes)" % (name, size))
+
+    def record_use(self, semitones):
+        if semitones:
+            self.usage[semitones] += 1
+
+    def prerender(self, song_path):
+        """Queue renders of the most requested semitone values for a song."""
+        for semitones, count in self.usage.most_common(self.prerender_count):
+            self.request(song_path, semitones)
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > self.keep:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
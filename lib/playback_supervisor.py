@@ -0,0 +1,68 @@
+import threading
+
+SLOW_INTERVAL = 2.0  # in seconds, status polling mid-song
+FAST_INTERVAL = 0.25  # in seconds, status polling close to the end of a track
+NEAR_END = 5  # in seconds before the end of a track, switch to fast polling
+END_MARGIN = 1  # in seconds, a track this close to its end is over
+
+
+class PlaybackSupervisor:
+    """The one thread that polls VLC's status in the background.
+
+    It samples the current track slowly mid-song and quickly near its end, reports every
+    sample through `on_position` and ends the track once it is over: the vocal track is
+    queued behind the accompaniment, so VLC would otherwise play on. It sleeps while no
+    track is being watched.
+    """
+
+    def __init__(self, client, on_position=None, logger=None):
+        self.client = client
+        self.on_position = on_position
+        self.logger = logger
+        self.track = None
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, track):
+        """Start watching `track`, the client's track counter once it is playing."""
+        self.track = track
+        self.wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def run(self):
+        timeout = None
+        while self.running:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            track = self.track
+            if track is None or track != self.client.track or not self.client.is_running():
+                # nothing to watch until the next watch() call
+                timeout = None
+                continue
+            try:
+                state = self.client.get_state()
+            except Exception as e:
+                self.logger.debug("Could not read VLC status: %s" % e)
+                timeout = SLOW_INTERVAL
+                continue
+            if self.on_position:
+                self.on_position(state)
+
+            length, position = state["length"], state["time"]
+            remaining = length - position if length else None
+            if state["state"] == "stopped" or (remaining is not None and remaining <= END_MARGIN):
+                self.logger.debug("Track %s is over" % track)
+                self.client.finish_track(track)
+                timeout = None
+            elif remaining is not None and state["state"] == "playing":
+                # wake up in time to catch the end of the track
+                timeout = max(FAST_INTERVAL, min(SLOW_INTERVAL, remaining - NEAR_END))
+            else:
+                timeout = SLOW_INTERVAL
+        self.logger.debug("Playback supervisor exits.")
@@ -0,0 +1,42 @@
+import threading
+
+
+class Prefetcher:
+    """Prepares the song at the head of the queue in the background.
+
+    `peek` returns the queue entry up next and `prepare` does the slow part of starting a
+    song (extracting, validating, reading ahead) for a song path. `notify` is called on
+    every queue change; the head is prepared once, however often it is notified.
+    """
+
+    def __init__(self, peek, prepare, logger=None):
+        self.peek = peek
+        self.prepare = prepare
+        self.logger = logger
+        self.prepared_file = None
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            song = self.peek()
+            if song is None or song["file"] == self.prepared_file:
+                continue
+            try:
+                self.prepare(song["file"])
+                self.prepared_file = song["file"]
+            except Exception as e:
+                self.logger.warning("Could not prepare next song %s: %s" % (song["file"], e))
+        self.logger.debug("Prefetcher exits.")
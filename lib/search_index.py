@@ -0,0 +1,115 @@
+import bisect
+import heapq
+import threading
+from array import array
+
+PAD = "\0\0"
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex:
+    """Inverted trigram index for substring search over song titles.
+
+    Items are integer ids and `key_of` returns the search key of an id. Each posting
+    list is a sorted array of 32-bit ids, which is several times smaller than a set and
+    stays sorted for free when ids are added in increasing order.
+
+    Keys are padded at the end so that every substring of one or two characters is
+    also the prefix of an indexed trigram; short queries are answered through the
+    `prefixes` map instead of scanning every key.
+    """
+
+    def __init__(self, key_of):
+        self.key_of = key_of
+        self.lock = threading.RLock()
+        self.postings = {}
+        self.prefixes = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item):
+        with self.lock:
+            for gram in trigrams(self.key_of(item) + PAD):
+                items = self.postings.get(gram)
+                if items is None:
+                    items = self.postings[gram] = array("I")
+                    self.prefixes.setdefault(gram[:1], set()).add(gram)
+                    self.prefixes.setdefault(gram[:2], set()).add(gram)
+                if not items or items[-1] < item:
+                    items.append(item)
+                else:
+                    bisect.insort(items, item)
+            self.size += 1
+
+    def remove(self, item):
+        with self.lock:
+            for gram in trigrams(self.key_of(item) + PAD):
+                items = self.postings.get(gram)
+                if items is None:
+                    continue
+                i = bisect.bisect_left(items, item)
+                if i < len(items) and items[i] == item:
+                    items.pop(i)
+                if not items:
+                    del self.postings[gram]
+                    for prefix in (gram[:1], gram[:2]):
+                        grams = self.prefixes[prefix]
+                        grams.discard(gram)
+                        if not grams:
+                            del self.prefixes[prefix]
+            self.size -= 1
+
+    def candidates(self, query):
+        if len(query) < 3:
+            candidates = set()
+            for gram in self.prefixes.get(query, ()):
+                candidates.update(self.postings[gram])
+            return candidates
+
+        postings = []
+        for gram in trigrams(query):
+            items = self.postings.get(gram)
+            if not items:
+                return []
+            postings.append(items)
+        postings.sort(key=len)
+        candidates = postings[0]
+        for items in postings[1:]:
+            candidates = [item for item in candidates if contains(items, item)]
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, query, limit=50):
+        """Ids whose key contains `query`, prefix matches first, then word-start matches."""
+        if not query:
+            return []
+        with self.lock:
+            matches = []
+            for item in self.candidates(query):
+                key = self.key_of(item)
+                pos = key.find(query)
+                if pos < 0:
+                    continue
+                if pos == 0:
+                    rank = 0
+                elif not key[pos - 1].isalnum():
+                    rank = 1
+                else:
+                    rank = 2
+                matches.append((rank, key, item))
+        if limit:
+            matches = heapq.nsmallest(limit, matches)
+        else:
+            matches.sort()
+        return [item for rank, key, item in matches]
+
+
+def contains(items, item):
+    i = bisect.bisect_left(items, item)
+    return i < len(items) and items[i] == item
@@ -0,0 +1,304 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import numpy
+
+from lib.cache_files import lower_priority
+
+SAMPLE_RATE = 44100
+MODEL = "spleeter:2stems"
+STEM = "accompaniment"
+SEGMENT_SECONDS = 30  # length of the pieces a song is separated in
+OVERLAP_SECONDS = 1  # shared by neighbouring pieces, crossfaded when joining them
+BLOCK = 1 << 16  # samples written to the encoder at a time when joining pieces
+
+
+def serve(jobs, results, threads):
+    """Worker process: load the model once, then separate the pieces of songs queued on
+    `jobs` back to back. Each piece is decoded here and its `STEM` part written to a raw
+    float32 file, so no audio goes through the web server's memory."""
+    lower_priority()
+    # workers share the cores between them rather than all competing for every one
+    os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(threads))
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", str(threads))
+    # imported here, so TensorFlow and the model only ever live in worker processes
+    from spleeter.separator import Separator
+
+    start = time.time()
+    try:
+        # spleeter's own process pool is off: a daemonic worker can't start children
+        separator = Separator(MODEL, multiprocess=False)
+        # the graph is built lazily, separate a moment of silence to have it ready for the first job
+        separator.separate(numpy.zeros((SAMPLE_RATE, 2), dtype=numpy.float32))
+    except Exception as e:
+        results.put((None, False, "could not load the model: %s" % e, 0, 0))
+        return
+    results.put((None, True, "model loaded in %.2fs" % (time.time() - start), 0, 0))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, file_path, offset, length, piece_path = job
+        start = time.time()
+        try:
+            waveform = load_audio(file_path, offset, length)
+            model_start = time.time()
+            stem = separator.separate(waveform)[STEM][: len(waveform)]
+            model_time = time.time() - model_start
+            stem.astype(numpy.float32).tofile(piece_path)
+        except Exception as e:
+            results.put((job_id, False, str(e), 0, 0))
+            continue
+        results.put((job_id, True, None, model_time, len(stem)))
+
+
+def segment_bounds(length, segment, overlap):
+    """(start, end) sample ranges covering `length` samples in pieces of `segment` samples,
+    each sharing `overlap` samples with the one before it."""
+    if not segment or length <= segment:
+        return [(0, length)]
+    if segment <= overlap:
+        raise ValueError("segments must be longer than their overlap")
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + segment, length)
+        bounds.append((start, end))
+        if end == length:
+            return bounds
+        start = end - overlap
+
+
+def probe_length(file_path):
+    """Length of the audio of a file in samples at SAMPLE_RATE, None if unknown."""
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "format=duration", "-of", "csv=p=0", file_path,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return int(float(result.stdout.decode().strip()) * SAMPLE_RATE)
+    except ValueError:
+        return None
+
+
+def load_audio(file_path, offset=0, length=None):
+    """Decode `length` samples (all up to the end if None) of the audio of a file from
+    sample `offset` on, as a (samples, 2) float32 array at SAMPLE_RATE. A range is padded
+    with silence or cut to exactly `length`, so pieces line up when joined."""
+    cmd = ["ffmpeg", "-v", "error"]
+    if offset:
+        cmd += ["-ss", "%.6f" % (offset / SAMPLE_RATE)]
+    cmd += ["-i", file_path, "-vn"]
+    if length:
+        cmd += ["-t", "%.6f" % (length / SAMPLE_RATE)]
+    cmd += ["-f", "f32le", "-ac", "2", "-ar", str(SAMPLE_RATE), "pipe:1"]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("could not decode audio: " + result.stderr.decode("utf-8", "replace").strip()[-1000:])
+    waveform = numpy.frombuffer(result.stdout, dtype=numpy.float32).reshape(-1, 2)
+    if length:
+        waveform = waveform[:length]
+        if len(waveform) < length:
+            waveform = numpy.concatenate([waveform, numpy.zeros((length - len(waveform), 2), numpy.float32)])
+    return waveform
+
+
+def join_pieces(piece_paths, overlap, out_path):
+    """Join the separated pieces (raw float32 files) into `out_path`, crossfading linearly
+    where neighbours overlap, in one streaming pass: the pieces are memory mapped and the
+    PCM is piped to ffmpeg a block at a time."""
+    cmd = [
+        "ffmpeg", "-y", "-v", "error", "-f", "f32le", "-ac", "2", "-ar", str(SAMPLE_RATE),
+        "-i", "pipe:0", out_path,
+    ]
+    encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        pieces = [numpy.memmap(path, dtype=numpy.float32, mode="r").reshape(-1, 2) for path in piece_paths]
+        # the fade-in of a piece and the fade-out of the one before it add up to 1
+        fade_in = ((numpy.arange(overlap, dtype=numpy.float32) + 0.5) / overlap).reshape(-1, 1) if overlap else None
+        for i, piece in enumerate(pieces):
+            body_start = overlap if i > 0 else 0
+            body_end = len(piece) - overlap if i < len(pieces) - 1 else len(piece)
+            for start in range(body_start, body_end, BLOCK):
+                encoder.stdin.write(numpy.ascontiguousarray(piece[start:min(start + BLOCK, body_end)]).tobytes())
+            if i < len(pieces) - 1:
+                # the last piece may come out shorter than the probed length said
+                head = pieces[i + 1][:overlap]
+                fade = fade_in[: len(head)]
+                blend = piece[body_end:body_end + len(head)] * (1 - fade) + head * fade
+                encoder.stdin.write(blend.astype(numpy.float32).tobytes())
+        encoder.stdin.close()
+    except BrokenPipeError:
+        pass
+    if encoder.wait() != 0:
+        raise RuntimeError("could not encode audio: " + encoder.stderr.read().decode("utf-8", "replace").strip()[-1000:])
+
+
+class SeparationService:
+    """Vocal/accompaniment separation in long-lived worker processes.
+
+    Starting spleeter per song means starting Python, importing TensorFlow and loading the
+    model every time. The workers do that once, on the first job, and keep TensorFlow's
+    memory out of the web server; they also decode the audio and write out what they
+    separate, so the server only streams the result to the encoder. A song is cut into
+    overlapping pieces of `segment` seconds that are separated by all workers in parallel
+    and crossfaded back together, so a song of any length takes about 1/`workers` of the
+    time it would take in one go. If a worker dies, the jobs in flight fail and the next
+    job starts a new pool. Workers run at a lower priority than the player.
+    """
+
+    def __init__(self, workers=1, segment=SEGMENT_SECONDS, overlap=OVERLAP_SECONDS, logger=None):
+        self.workers = max(1, workers)
+        self.segment = segment
+        self.overlap = overlap
+        self.logger = logger
+        self.context = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.waiting = {}
+        self.processes = None
+        self.ready = 0  # workers of the current pool that have loaded the model
+
+    def start(self):
+        with self.lock:
+            if self.processes is not None and all(p.is_alive() for p in self.processes):
+                return
+            self.terminate(self.processes)
+            self.jobs = self.context.Queue()
+            self.ready = 0
+            results = self.context.Queue()
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            self.processes = [
+                self.context.Process(target=serve, args=(self.jobs, results, threads))
+                for i in range(self.workers)
+            ]
+            for process in self.processes:
+                process.daemon = True
+                process.start()
+            reader = threading.Thread(target=self.read_results, args=(self.processes, results))
+            reader.daemon = True
+            reader.start()
+        self.logger.info("Started separation service, %d workers" % self.workers)
+
+    def terminate(self, processes):
+        for process in processes or []:
+            if process.is_alive():
+                process.terminate()
+
+    def read_results(self, processes, results):
+        error = "separation service exited"
+        while True:
+            try:
+                job_id, ok, message, model_time, samples = results.get(timeout=1)
+            except queue.Empty:
+                if all(p.is_alive() for p in processes):
+                    continue
+                # a worker died, fail whatever the pool had been given
+                with self.lock:
+                    lost = [job_id for job_id, job in self.waiting.items() if job[2] is processes]
+                    lost = [self.waiting.pop(job_id) for job_id in lost]
+                    if self.processes is processes:
+                        self.terminate(processes)
+                        self.processes = None
+                for event, result, job_processes in lost:
+                    result.append((False, error, 0, 0))
+                    event.set()
+                return
+            if job_id is None and not ok:
+                error = message
+                self.logger.error("Separation worker failed: %s" % message)
+                continue
+            if job_id is None:
+                with self.lock:
+                    if self.processes is processes:
+                        self.ready += 1
+                self.logger.debug("Separation worker ready: %s" % message)
+                continue
+            with self.lock:
+                event, result, job_processes = self.waiting.pop(job_id, (None, None, None))
+            if event:
+                result.append((ok, message, model_time, samples))
+                event.set()
+
+    def separate(self, file_path, output_path, timeout=None, segment=None):
+        """Separate `file_path` into `accompaniment.wav` in `output_path`, in pieces of
+        `segment` seconds (the service's default if None, in one go if 0). Blocks until the
+        job is done, returns True on success."""
+        start = time.time()
+        segment = self.segment if segment is None else segment
+        overlap = self.overlap * SAMPLE_RATE
+        piece_paths = []
+        try:
+            length = probe_length(file_path)
+            if length is None:
+                # unknown length, decode it all in one piece
+                bounds = [(0, None)]
+            else:
+                bounds = segment_bounds(length, segment * SAMPLE_RATE, overlap)
+            piece_paths = [os.path.join(output_path, "piece%d.f32" % i) for i in range(len(bounds))]
+            self.start()
+            pending = []
+            with self.lock:
+                for i, (piece_start, piece_end) in enumerate(bounds):
+                    event, result = threading.Event(), []
+                    job_id = next(self.job_ids)
+                    self.waiting[job_id] = (event, result, self.processes)
+                    # the last piece runs up to the end, whatever the probed length said
+                    piece_length = None if i == len(bounds) - 1 else piece_end - piece_start
+                    self.jobs.put((job_id, file_path, piece_start, piece_length, piece_paths[i]))
+                    pending.append((job_id, event, result))
+
+            deadline = None if timeout is None else time.time() + timeout
+            model_time = samples = 0
+            for job_id, event, result in pending:
+                if not event.wait(None if deadline is None else max(0, deadline - time.time())):
+                    with self.lock:
+                        for each in pending:
+                            self.waiting.pop(each[0], None)
+                    raise RuntimeError("timed out")
+                ok, message, piece_time, piece_samples = result[0]
+                if not ok:
+                    raise RuntimeError(message)
+                model_time += piece_time
+                samples += piece_samples
+            separated = time.time()
+            join_pieces(piece_paths, overlap if len(bounds) > 1 else 0, os.path.join(output_path, STEM + ".wav"))
+        except (OSError, RuntimeError) as e:
+            self.logger.error("Separation of %s failed: %s" % (file_path, e))
+            return False
+        finally:
+            for path in piece_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.logger.info(
+            "Separated %s (%.0fs of audio, %d pieces) in %.2fs (separate: %.2fs, model: %.2fs over %d workers, join: %.2fs)"
+            % (
+                file_path,
+                (samples - overlap * (len(bounds) - 1)) / SAMPLE_RATE,
+                len(bounds),
+                time.time() - start,
+                separated - start,
+                model_time,
+                self.workers,
+                time.time() - separated,
+            )
+        )
+        return True
+
+    def stop(self):
+        with self.lock:
+            processes, self.processes = self.processes, None
+        if processes is None:
+            return
+        for process in processes:
+            self.jobs.put(None)
+        for process in processes:
+            process.join(5)
+        self.terminate(processes)
@@ -0,0 +1,199 @@
+import heapq
+import os
+import sys
+import threading
+
+from lib.search_index import TrigramIndex
+from lib.song_library import parse_song_file
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def letter_bucket(search_key):
+    """The /browse bucket of a song: "a" to "z", "numeric", or None for anything else."""
+    first = search_key[:1]
+    if first.isnumeric():
+        return "numeric"
+    if first in LETTERS:
+        return first
+    return None
+
+
+class Song:
+    """One catalog entry. The directory string is interned, so songs in the same folder
+    share it, and title and keys are derived once when the song is cataloged."""
+
+    __slots__ = ("id", "dir", "name", "title", "key", "sort_key", "ctime")
+
+    def __init__(self, song_id, path, search_key, ctime):
+        dir_path, name = os.path.split(path)
+        self.id = song_id
+        self.dir = sys.intern(dir_path)
+        self.name = name
+        self.title = parse_song_file(name)[0]
+        self.key = search_key
+        self.sort_key = name.lower()
+        self.ctime = ctime
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.name)
+
+
+def alphabetical(song):
+    return (song.sort_key, song.dir, song.name)
+
+
+def newest_first(song):
+    return (-song.ctime, song.sort_key, song.dir, song.name)
+
+
+class SortedView:
+    """A list of songs kept sorted by `key`."""
+
+    def __init__(self, key, items=()):
+        self.key = key
+        self.items = sorted(items, key=key)
+
+    def __len__(self):
+        return len(self.items)
+
+    def page(self, after=None, limit=50):
+        """Up to `limit` songs following the song whose key is `after`, or from the start."""
+        start = 0 if after is None else self.bisect_right(after)
+        return self.items[start:start + limit]
+
+    def bisect_right(self, key):
+        # bisect's key= argument needs Python 3.10, and a parallel list of keys would double
+        # what the views hold
+        lo, hi = 0, len(self.items)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self.key(self.items[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def updated(self, added, removed):
+        """A new view with the `added` songs merged in and the `removed` ones dropped."""
+        view = SortedView(self.key)
+        kept = self.items
+        if removed:
+            kept = [song for song in kept if song not in removed]
+        view.items = list(heapq.merge(kept, sorted(added, key=self.key), key=self.key))
+        return view
+
+
+class SongCatalog:
+    """In-memory views of the available songs, maintained as the library changes.
+
+    Besides the full alphabetical list there is one view per /browse letter bucket, a
+    newest-first view of each, a trigram index over the search keys and a map from youtube
+    id to the files downloaded from that video, so requests only slice or query
+    precomputed structures. Views are replaced, never modified in place,
+    so readers always see a consistent snapshot without locking.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = []
+        self.dirs = {}
+        self.views = {}
+        self.index = TrigramIndex(self.key_of)
+        self.youtube_files = {}
+
+    def __len__(self):
+        return len(self.get_songs())
+
+    @property
+    def songs(self):
+        return self.get_songs().items
+
+    def key_of(self, song_id):
+        return self.records[song_id].key
+
+    def get(self, path):
+        dir_path, name = os.path.split(path)
+        return self.dirs.get(dir_path, {}).get(name)
+
+    def get_songs(self, letter=None, by_date=False):
+        view = self.views.get((letter, by_date))
+        if view is None:
+            view = SortedView(newest_first if by_date else alphabetical)
+        return view
+
+    def update(self, added, removed):
+        """Apply library changes: `added` holds (path, search key, ctime) rows, `removed` paths."""
+        with self.lock:
+            changes = {}
+            for path in list(removed) + [row[0] for row in added]:
+                song = self.get(path)
+                if song is None:
+                    continue
+                for view in self.views_of(song):
+                    changes.setdefault(view, ([], set()))[1].add(song)
+                self.index.remove(song.id)
+                self.records[song.id] = None
+                names = self.dirs[song.dir]
+                del names[song.name]
+                if not names:
+                    del self.dirs[song.dir]
+
+            for path, search_key, ctime in added:
+                song = Song(len(self.records), path, search_key, ctime)
+                self.records.append(song)
+                self.dirs.setdefault(song.dir, {})[song.name] = song
+                for view in self.views_of(song):
+                    changes.setdefault(view, ([], set()))[0].append(song)
+                self.index.add(song.id)
+
+            for view, (added_songs, removed_songs) in changes.items():
+                self.views[view] = self.get_songs(*view).updated(added_songs, removed_songs)
+
+            # ids are never reused, compact once removed songs make up most of the records
+            if len(self.records) > 1000 and len(self) < len(self.records) // 2:
+                self.compact()
+
+    def compact(self):
+        songs = self.songs
+        self.records = list(songs)
+        index = TrigramIndex(self.key_of)
+        for song_id, song in enumerate(songs):
+            song.id = song_id
+            index.add(song_id)
+        self.index = index
+
+    def update_files(self, added, removed):
+        """Keep the youtube id -> file paths map current. Unlike `update`, this takes every
+        cataloged file: originals, both stems and .cdg files."""
+        with self.lock:
+            for path in removed:
+                youtube_id = parse_song_file(path)[1]
+                files = self.youtube_files.get(youtube_id, ())
+                if path in files:
+                    files = tuple(f for f in files if f != path)
+                    if files:
+                        self.youtube_files[youtube_id] = files
+                    else:
+                        del self.youtube_files[youtube_id]
+            for path in added:
+                youtube_id = parse_song_file(path)[1]
+                if youtube_id:
+                    files = self.youtube_files.get(youtube_id, ())
+                    if path not in files:
+                        self.youtube_files[youtube_id] = files + (path,)
+
+    def get_youtube_files(self, youtube_id):
+        return self.youtube_files.get(youtube_id, ())
+
+    def views_of(self, song):
+        views = [(None, False), (None, True)]
+        letter = letter_bucket(song.key)
+        if letter:
+            views += [(letter, False), (letter, True)]
+        return views
+
+    def search(self, search_key, limit=50):
+        with self.lock:
+            return [self.records[song_id] for song_id in self.index.search(search_key, limit)]
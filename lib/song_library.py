@@ -0,0 +1,312 @@
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import *
+from lib.normalize import normalize_key
+
+SONG_EXTENSIONS = [".mp4", ".mp3", ".zip", ".mkv", ".avi", ".webm", ".mov"]
+COMPANION_EXTENSIONS = [".cdg"]
+CATALOG_EXTENSIONS = SONG_EXTENSIONS + COMPANION_EXTENSIONS
+MTIME_GRANULARITY = 2  # in seconds
+SCHEMA_VERSION = 2
+
+
+def parse_song_file(file_path):
+    """Split a song file name into (title, youtube_id, ext, stem).
+
+    Downloaded files follow the "<title>---<youtube id><stem suffix>.<ext>" convention,
+    where the stem suffix marks the accompaniment or vocal half of a spleeter pair.
+    """
+    base, ext = os.path.splitext(os.path.basename(file_path))
+    stem = ""
+    if base.endswith(ACCOMPANIMENT_SUFFIX):
+        stem = "accompaniment"
+        base = base[: -len(ACCOMPANIMENT_SUFFIX)]
+    elif base.endswith(VOCAL_SUFFIX):
+        stem = "vocal"
+        base = base[: -len(VOCAL_SUFFIX)]
+    parts = base.split("---", 1)
+    youtube_id = parts[1] if len(parts) == 2 else None
+    return parts[0], youtube_id, ext.lower(), stem
+
+
+class SongLibrary:
+    """Persistent catalog of the song files found under one or more library roots.
+
+    Every directory is stored with its mtime. A refresh only lists directories whose
+    mtime changed since the last pass, and walks unchanged ones through the children
+    remembered in the catalog, so a quiet library costs one stat() per directory.
+    Roots on different devices are walked in parallel, one thread per device.
+    """
+
+    def __init__(self, roots, db_path=LIBRARY_DB_PATH, logger=None):
+        if isinstance(roots, str):
+            roots = [roots]
+        self.roots = [os.path.abspath(os.path.expanduser(root)) for root in roots]
+        self.db_path = os.path.expanduser(db_path)
+        self.logger = logger
+        self.lock = threading.RLock()
+
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.conn:
+            # the catalog is only a cache of the file system, so an outdated schema is
+            # simply dropped and rebuilt by the next refresh
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.conn.execute("DROP TABLE IF EXISTS dirs")
+                self.conn.execute("DROP TABLE IF EXISTS files")
+                self.conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    root TEXT NOT NULL,
+                    parent TEXT,
+                    mtime REAL NOT NULL
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    root TEXT NOT NULL,
+                    dir TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    search_key TEXT NOT NULL,
+                    sort_key TEXT NOT NULL,
+                    youtube_id TEXT,
+                    ext TEXT NOT NULL,
+                    stem TEXT NOT NULL,
+                    pair_path TEXT,
+                    mtime REAL,
+                    ctime REAL,
+                    size INTEGER
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_youtube_id ON files (youtube_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_sort_key ON files (root, stem, sort_key)")
+
+    def roots_clause(self):
+        return "root IN (%s)" % ", ".join("?" * len(self.roots))
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def refresh(self, dirs=None):
+        """Reconcile the catalog with the file system.
+
+        Without `dirs` all roots are checked, otherwise only the given directories (and
+        any new subdirectories found in them) are rescanned. Returns the (added, removed)
+        file paths, the added ones sorted like get_songs().
+        """
+        start = time.time()
+        removed = []
+        with self.lock:
+            known = {}
+            children = {}
+            for path, parent, mtime in self.conn.execute(
+                "SELECT path, parent, mtime FROM dirs WHERE " + self.roots_clause(), self.roots
+            ):
+                known[path] = mtime
+                children.setdefault(parent, []).append(path)
+
+            forced = set() if dirs is None else set(d for d in dirs if self.root_of(d))
+            starts = self.roots if dirs is None else forced
+            # one walker per device: parallel walks only pay off across disks
+            devices = {}
+            for dir_path in starts:
+                try:
+                    device = os.stat(dir_path).st_dev
+                except OSError:
+                    device = None
+                devices.setdefault(device, []).append(dir_path)
+            walk = lambda paths: self.walk(paths, known, children, forced)
+            if len(devices) > 1:
+                with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+                    results = list(pool.map(walk, devices.values()))
+            else:
+                results = [walk(paths) for paths in devices.values()]
+
+            seen = set()
+            rescanned = 0
+            added_runs = []
+            with self.conn:
+                for scans, walked in results:
+                    seen.update(walked)
+                    rescanned += len(scans)
+                    added_rows = []
+                    for dir_path, mtime, rows, subdirs in scans:
+                        self.store_dir(dir_path, mtime, rows, added_rows, removed)
+                        for subdir in set(children.get(dir_path, [])) - set(subdirs):
+                            self.remove_dir_tree(subdir, removed)
+                    added_rows.sort(key=lambda row: row[5])
+                    added_runs.append(added_rows)
+
+                gone = set(known) if dirs is None else forced
+                for dir_path in gone - seen:
+                    self.remove_dir_tree(dir_path, removed)
+
+        # each walker's additions are already sorted, so combine them with a k-way merge
+        added = [row[0] for row in heapq.merge(*added_runs, key=lambda row: row[5])]
+        if self.logger:
+            self.logger.debug(
+                "Library refresh: %d dirs checked on %d devices, %d rescanned, %d files added, %d removed in %.3fs"
+                % (len(seen), len(devices), rescanned, len(added), len(removed), time.time() - start)
+            )
+        return added, removed
+
+    def walk(self, starts, known, children, forced):
+        """Walk directory trees without touching the database, so walkers can run in
+        parallel. Returns the (dir, mtime, rows, subdirs) scans of changed directories
+        and the set of directories seen."""
+        scans = []
+        seen = set()
+        stack = [(dir_path, self.root_of(dir_path)) for dir_path in starts]
+        while stack:
+            dir_path, root = stack.pop()
+            if dir_path in seen:
+                continue
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+            seen.add(dir_path)
+            if dir_path not in forced and known.get(dir_path) == mtime:
+                stack.extend((subdir, root) for subdir in children.get(dir_path, []))
+                continue
+            scan = self.scan_dir(dir_path, root)
+            if scan is None:
+                continue
+            rows, subdirs = scan
+            scans.append((dir_path, mtime, rows, subdirs))
+            stack.extend((subdir, root) for subdir in subdirs)
+        return scans, seen
+
+    def scan_dir(self, dir_path, root):
+        """Catalog rows and subdirectories of a single directory, None if it can't be listed.
+
+        The DirEntry objects from scandir carry the file type (and on Windows the stat
+        result), so only song files cost an extra stat() call.
+        """
+        subdirs = []
+        rows = {}
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in CATALOG_EXTENSIONS and entry.is_file():
+                        st = entry.stat()
+                        title, youtube_id, ext, stem = parse_song_file(entry.name)
+                        rows[entry.path] = [
+                            entry.path,
+                            root,
+                            dir_path,
+                            title,
+                            normalize_key(title),
+                            entry.name.lower(),
+                            youtube_id,
+                            ext,
+                            stem,
+                            None,
+                            st.st_mtime,
+                            st.st_ctime,
+                            st.st_size,
+                        ]
+        except OSError as e:
+            if self.logger:
+                self.logger.warning("Could not scan directory %s: %s" % (dir_path, e))
+            return None
+
+        # pair each accompaniment file with its vocal half, they always share a directory
+        for path, row in rows.items():
+            if row[8] == "accompaniment":
+                vocal_path = path.replace(ACCOMPANIMENT_SUFFIX, VOCAL_SUFFIX)
+                if vocal_path in rows:
+                    row[9] = vocal_path
+        return rows, subdirs
+
+    def store_dir(self, dir_path, mtime, rows, added_rows, removed):
+        """Replace the catalog rows of a single directory."""
+        # coarse mtime resolution (FAT, some NAS mounts) can hide a change made right after
+        # the scan, so a directory modified just now is rescanned on the next pass as well
+        if time.time() - mtime < MTIME_GRANULARITY:
+            mtime = -1
+        root = self.root_of(dir_path)
+        parent = None if dir_path == root else os.path.dirname(dir_path)
+        old_paths = set(
+            row[0] for row in self.conn.execute("SELECT path FROM files WHERE dir = ?", (dir_path,))
+        )
+        added_rows.extend(row for path, row in rows.items() if path not in old_paths)
+        removed.extend(path for path in old_paths if path not in rows)
+        self.conn.execute("DELETE FROM files WHERE dir = ?", (dir_path,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows.values(),
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (dir_path, root, parent, mtime)
+        )
+
+    def remove_dir_tree(self, dir_path, removed):
+        prefix = dir_path + os.sep
+        removed.extend(
+            row[0]
+            for row in self.conn.execute(
+                "SELECT path FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?",
+                (dir_path, len(prefix), prefix),
+            )
+        )
+        for table, column in (("files", "dir"), ("dirs", "path")):
+            self.conn.execute(
+                "DELETE FROM %s WHERE %s = ? OR substr(%s, 1, ?) = ?" % (table, column, column),
+                (dir_path, len(prefix), prefix),
+            )
+
+    def get_songs(self, paths=None):
+        """Playable songs (accompaniment files) as (path, search key, ctime) rows, sorted
+        case-insensitively by file name. With `paths`, only the rows of those files."""
+        query = "SELECT path, search_key, ctime FROM files WHERE stem = 'accompaniment' AND " + self.roots_clause()
+        with self.lock:
+            if paths is None:
+                return self.conn.execute(query + " ORDER BY sort_key", self.roots).fetchall()
+            rows = []
+            for path in paths:
+                row = self.conn.execute(query + " AND path = ?", self.roots + [path]).fetchone()
+                if row:
+                    rows.append(row)
+            return rows
+
+    def get_song_info(self, file_path):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, title, search_key, youtube_id, ext, stem, pair_path, mtime, ctime, size FROM files WHERE path = ?",
+                (file_path,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ["path", "title", "search_key", "youtube_id", "ext", "stem", "pair_path", "mtime", "ctime", "size"]
+        return dict(zip(keys, row))
+
+    def get_youtube_files(self):
+        """Paths of all cataloged files that carry a youtube id in their name."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM files WHERE youtube_id IS NOT NULL AND " + self.roots_clause(), self.roots
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,161 @@
+import itertools
+import threading
+
+
+class SongQueue:
+    """Thread-safe song queue.
+
+    Every entry gets an id that stays the same for as long as it is queued, so the web UI
+    can move or delete an entry even while other clients change the queue. Entries form a
+    doubly linked list kept in dicts keyed by id, which makes popping the head, moving and
+    deleting by id O(1), and a count per file path makes membership checks O(1).
+    `on_change` is called after every change to the queue.
+    """
+
+    def __init__(self, on_change=None):
+        self.lock = threading.RLock()
+        self.on_change = on_change
+        self.ids = itertools.count(1)
+        self.entries = {}
+        self.prev = {}
+        self.next = {}
+        self.head = None
+        self.tail = None
+        self.paths = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, song_path):
+        return song_path in self.paths
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def to_list(self):
+        """A snapshot of the entries, in play order."""
+        with self.lock:
+            entries = []
+            entry_id = self.head
+            while entry_id is not None:
+                entries.append(self.entries[entry_id])
+                entry_id = self.next[entry_id]
+            return entries
+
+    def get(self, entry_id):
+        return self.entries.get(entry_id)
+
+    def peek(self):
+        """The entry up next, or None if the queue is empty."""
+        with self.lock:
+            return None if self.head is None else self.entries[self.head]
+
+    def append(self, song_path, title, user, unique=True):
+        """Add a song at the end of the queue. Returns the new entry, or None if `unique`
+        is set and the song is already queued."""
+        with self.lock:
+            if unique and song_path in self.paths:
+                return None
+            entry = {"id": next(self.ids), "user": user, "file": song_path, "title": title}
+            entry_id = entry["id"]
+            self.entries[entry_id] = entry
+            self.prev[entry_id] = self.tail
+            self.next[entry_id] = None
+            if self.tail is None:
+                self.head = entry_id
+            else:
+                self.next[self.tail] = entry_id
+            self.tail = entry_id
+            self.paths[song_path] = self.paths.get(song_path, 0) + 1
+        self.changed()
+        return entry
+
+    def pop(self):
+        """Remove and return the entry up next, or None if the queue is empty."""
+        with self.lock:
+            if self.head is None:
+                return None
+            return self.remove(self.head)
+
+    def remove(self, entry_id):
+        """Remove an entry by id. Returns the entry, or None if it isn't queued."""
+        with self.lock:
+            entry = self.entries.pop(entry_id, None)
+            if entry is None:
+                return None
+            self.unlink(entry_id)
+            del self.prev[entry_id]
+            del self.next[entry_id]
+            count = self.paths[entry["file"]] - 1
+            if count:
+                self.paths[entry["file"]] = count
+            else:
+                del self.paths[entry["file"]]
+        self.changed()
+        return entry
+
+    def move_up(self, entry_id):
+        """Swap an entry with the one before it. Returns False if it is first or not queued."""
+        with self.lock:
+            if entry_id not in self.entries or self.prev[entry_id] is None:
+                return False
+            before = self.prev[entry_id]
+            self.unlink(entry_id)
+            self.link_before(entry_id, before)
+        self.changed()
+        return True
+
+    def move_down(self, entry_id):
+        """Swap an entry with the one after it. Returns False if it is last or not queued."""
+        with self.lock:
+            if entry_id not in self.entries or self.next[entry_id] is None:
+                return False
+            after = self.next[entry_id]
+            self.unlink(entry_id)
+            self.link_after(entry_id, after)
+        self.changed()
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.prev.clear()
+            self.next.clear()
+            self.paths.clear()
+            self.head = self.tail = None
+        self.changed()
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def unlink(self, entry_id):
+        before, after = self.prev[entry_id], self.next[entry_id]
+        if before is None:
+            self.head = after
+        else:
+            self.next[before] = after
+        if after is None:
+            self.tail = before
+        else:
+            self.prev[after] = before
+
+    def link_before(self, entry_id, other_id):
+        before = self.prev[other_id]
+        self.prev[entry_id] = before
+        self.next[entry_id] = other_id
+        self.prev[other_id] = entry_id
+        if before is None:
+            self.head = entry_id
+        else:
+            self.next[before] = entry_id
+
+    def link_after(self, entry_id, other_id):
+        after = self.next[other_id]
+        self.prev[entry_id] = other_id
+        self.next[entry_id] = after
+        self.next[other_id] = entry_id
+        if after is None:
+            self.tail = entry_id
+        else:
+            self.prev[after] = entry_id
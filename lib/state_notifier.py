@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+
+class StateNotifier:
+    """Versions the player and queue state and wakes up the threads waiting for it to change.
+
+    Every change bumps `version` and stamps it on the topics it touched ("nowplaying",
+    "queue"), so each topic's version only grows, and a waiter that was busy while a
+    change happened still sees it the next time it calls `wait`. The JSON of each topic
+    is serialized once per version and shared by every client asking for it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # tells apart the versions of different runs, for ETags cached by browsers
+        self.epoch = "%x" % int(time.time())
+        self.version = 0
+        self.versions = {}
+        self.cache = {}
+
+    def notify(self, *topics):
+        with self.condition:
+            self.version += 1
+            for topic in topics:
+                self.versions[topic] = self.version
+            self.condition.notify_all()
+
+    def get_version(self, topic=None):
+        return self.version if topic is None else self.versions.get(topic, 0)
+
+    def wait(self, since=None, timeout=None, topic=None):
+        """Block until the version of `topic` (of any topic if None) differs from `since`
+        or `timeout` seconds have passed. Returns the current version."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.get_version(topic) != since, timeout)
+            return self.get_version(topic)
+
+    def get_json(self, topic, build):
+        """(version, JSON) of a topic, where `build` returns its current state."""
+        with self.condition:
+            version = self.get_version(topic)
+            cached = self.cache.get(topic)
+        if cached and cached[0] == version:
+            return cached
+        # built outside the condition, `build` may take locks that are held while notifying.
+        # A change that lands meanwhile bumps the version again, so this is rebuilt next time.
+        cached = (version, json.dumps(build()))
+        with self.condition:
+            if self.get_version(topic) == version:
+                self.cache[topic] = cached
+        return cached
@@ -1,20 +1,31 @@
 import os
 import re
 import random
-import shutil
 import string
 import subprocess
 import sys
 import time
 import xml.etree.ElementTree as ET
-import zipfile
-from threading import Timer
+from collections import OrderedDict, deque
+from urllib.parse import quote
 from constants import *
 import threading
 
 import requests
 
+from lib.extraction_cache import ExtractionCache
 from lib.get_platform import get_platform
+from lib.playback_supervisor import PlaybackSupervisor
+
+STARTUP_TIMEOUT = 15  # in seconds, until VLC reports a new track as playing
+PROBE_INTERVAL = 0.02  # in seconds, first status poll, doubled up to PROBE_MAX_INTERVAL
+PROBE_MAX_INTERVAL = 0.5
+STATUS_TTL = 0.25  # in seconds, how long a fetched status.xml is reused
+HTTP_TIMEOUT = 5  # in seconds
+PREPARED_MAX = 3  # prepared songs kept: the one playing, the next one and a spare
+WARM_BYTES = 64 * 1024 * 1024  # read ahead into the page cache when preparing a song
+# options that apply to the input being played only, not to the other half of the pair
+INPUT_ONLY_OPTIONS = ("--input-slave", "--audio-track")
 
 
 def get_default_vlc_path(platform):
@@ -31,7 +42,7 @@ def get_default_vlc_path(platform):
 
 
 class VLCClient:
-    def __init__(self, port=5002, path=None, qrcode=None, url=None, logger=None):
+    def __init__(self, port=5002, path=None, qrcode=None, url=None, on_exit=None, on_position=None, persistent=False, logger=None):
 
         # HTTP remote control server
         self.http_password = "".join(
@@ -40,12 +51,30 @@ class VLCClient:
         self.port = port
         self.http_endpoint = "http://localhost:%s/requests/status.xml" % self.port
         self.http_command_endpoint = self.http_endpoint + "?command="
+        # keep-alive connections to the http interface, reused by every request
+        self.session = requests.Session()
+        self.session.auth = ("", self.http_password)
+        self.status_lock = threading.Lock()
+        self.status = None
+        self.status_time = 0
+        self.status_generation = 0
         self.is_transposing = False
 
         self.qrcode = qrcode
         self.url = url
         self.logger = logger
-        self.listener = None
+        # called at the end of every track: when a VLC process exits, or in persistent
+        # mode when a track is stopped or VLC crashed
+        self.on_exit = on_exit
+        # persistent mode keeps a single VLC running and swaps tracks through its playlist
+        self.persistent = persistent
+        self.track = 0
+        self.track_file = None
+        self.track_multitrack = False
+        # seconds from play_file() until VLC reported the song as playing, per song
+        self.first_frame_times = deque(maxlen=100)
+        # (VLC time, time.monotonic() when sampled, state, length) of the last status
+        self.clock = None
 
         # Handle vlc paths
         self.platform = get_platform()
@@ -64,7 +93,10 @@ class VLCClient:
         self.cmd_base = [
             self.path,
             "-f",
-            "--play-and-exit",
+        ]
+        if not self.persistent:
+            self.cmd_base += ["--play-and-exit"]
+        self.cmd_base += [
             "--extraintf",
             "http",
             "--http-port",
@@ -91,16 +123,19 @@ class VLCClient:
 
         self.volume_offset = 10
         self.process = None
+        self.supervisor = PlaybackSupervisor(self, on_position=on_position, logger=self.logger)
+        # (song path, mtime) -> playable path, see prepare_file()
+        self.prepared = OrderedDict()
+        self.prepare_lock = threading.Lock()
+        self.extraction_cache = ExtractionCache(
+            os.path.join(self.tmp_dir, "extracted"), EXTRACTION_CACHE_BYTES, logger=self.logger
+        )
 
     def get_marquee_cmd(self):
         return ["--sub-source", 'logo{file=%s,position=9,x=2,opacity=200}:marq{marquee="Pikaraoke - connect at: \n%s",position=9,x=38,color=0xFFFFFF,size=11,opacity=200}' % (self.qrcode, self.url)]
 
     def handle_zipped_cdg(self, file_path):
-        extracted_dir = os.path.join(self.tmp_dir, "extracted")
-        if (os.path.exists(extracted_dir)):
-            shutil.rmtree(extracted_dir)
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(extracted_dir)
+        extracted_dir = self.extraction_cache.get(file_path)
 
         mp3_file = None
         cdg_file = None
@@ -116,7 +151,7 @@ class VLCClient:
             if (os.path.splitext(mp3_file)[0] == os.path.splitext(cdg_file)[0]):
                 return os.path.join(extracted_dir, mp3_file)
             else:
-                raise Exception("Zipped .mp3 file did not have a matching .cdg file: " + files)
+                raise Exception("Zipped .mp3 file did not have a matching .cdg file: " + str(files))
         else:
             raise Exception("No .mp3 or .cdg was found in the zip file: " + file_path)
 
@@ -141,46 +176,245 @@ class VLCClient:
         else:
             return file_path
 
-    def play_file(self, file_path, additional_parameters=None, playing_type=ACCOMPANIMENT_SUFFIX):
+    def prepare_file(self, file_path):
+        """The path to hand to VLC for a song: .zip packs are extracted and .mp3 files
+        checked for their .cdg. The result is kept, so a song prepared ahead of time
+        starts without that work."""
+        key = (file_path, os.path.getmtime(file_path))
+        with self.prepare_lock:
+            path = self.prepared.get(key)
+            if path is not None:
+                self.prepared.move_to_end(key)
+        if path is not None and os.path.exists(path):
+            return path
+        # outside the lock, so extracting one pack doesn't hold up any other song. The
+        # extraction cache makes concurrent callers for the same pack wait for one another.
+        path = self.process_file(file_path)
+        with self.prepare_lock:
+            self.prepared[key] = path
+            while len(self.prepared) > PREPARED_MAX:
+                self.prepared.popitem(last=False)
+        return path
+
+    def prefetch(self, file_path):
+        """Prepare a song that is about to play and read the start of its files into the
+        page cache."""
+        start = time.time()
+        path = self.prepare_file(file_path)
+        vocal_path = file_path.replace(ACCOMPANIMENT_SUFFIX, VOCAL_SUFFIX)
+        if vocal_path != file_path and not os.path.exists(vocal_path) and not self.is_multitrack(file_path):
+            self.logger.warning("No vocal track for: " + file_path)
+        for each in (path, vocal_path, os.path.splitext(path)[0] + ".cdg"):
+            if os.path.exists(each):
+                self.warm_file(each)
+        self.logger.debug("Prepared in %.2fs: %s" % (time.time() - start, file_path))
+
+    def warm_file(self, file_path):
+        with open(file_path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, WARM_BYTES, os.POSIX_FADV_WILLNEED)
+            else:
+                remaining = WARM_BYTES
+                while remaining > 0 and f.read(min(remaining, 1024 * 1024)):
+                    remaining -= 1024 * 1024
+
+    def play_file(self, file_path, additional_parameters=None, playing_type=ACCOMPANIMENT_SUFFIX, start_time=0):
+        if start_time:
+            additional_parameters = (additional_parameters or []) + ["--start-time", "%d" % start_time]
+        if self.persistent:
+            return self.play_file_persistent(file_path, additional_parameters, playing_type)
+        start = time.time()
+        self.track += 1
+        track = self.track
+        self.clock = None
         try:
 
-            accompaniment_path = self.process_file(file_path)
-            vocal_path = file_path.replace(ACCOMPANIMENT_SUFFIX, VOCAL_SUFFIX)
-
-            if playing_type == ACCOMPANIMENT_SUFFIX:
-                first_file, second_file = accompaniment_path, vocal_path
-            else:
-                first_file, second_file = vocal_path, accompaniment_path
+            first_file, second_file, params = self.playlist_files(file_path, playing_type, additional_parameters)
 
             if self.is_playing() or self.is_paused():
                 self.logger.debug("VLC is currently playing, stopping track...")
-                self.stop()
-                # this pause prevents vlc http server from being borked after transpose
-                time.sleep(0.2)
+                # with --play-and-exit, VLC only quits at the end of its playlist, not on a stop.
+                # The new VLC can't bind the http port until the old one is gone
+                self.kill()
+                self.process.wait()
             if self.platform == "windows":
                 first_file = r"{}".format(first_file.replace('/', '\\'))
-                second_file = r"{}".format(second_file.replace('/', '\\'))
+                if second_file:
+                    second_file = r"{}".format(second_file.replace('/', '\\'))
 
-            if additional_parameters == None:
-                command = self.cmd_base + [first_file]
-            else:
-                command = self.cmd_base + additional_parameters + [first_file]
+            params, input_options = self.split_input_options(params)
+            # options of the first input only, as ":name=value" after its path
+            command = self.cmd_base + params + [first_file] + input_options
             self.logger.debug("VLC Command: %s" % command)
             self.process = subprocess.Popen(
                 command, shell=(self.platform == "windows"), stdin=subprocess.PIPE
             )
-            time.sleep(2)
-
-            if os.path.exists(second_file):
+            watcher = threading.Thread(target=self.wait_process, args=[self.process])
+            watcher.daemon = True
+            watcher.start()
+            if self.wait_until_ready(["playing"]) is None:
+                self.logger.error("VLC did not start playing within %ss: %s" % (STARTUP_TIMEOUT, file_path))
+                return
+            self.record_first_frame(file_path, start)
+
+            if second_file and os.path.exists(second_file):
                 self.add_song(second_file)
 
-            time.sleep(1)
-            listener = threading.Thread(target=self.listen_status)
-            listener.start()
+            self.supervisor.watch(track)
         except Exception as e:
             self.logger.error("Playing file failed: " + str(e))
 
-    def play_file_transpose(self, file_path, semitones):
+    def play_file_persistent(self, file_path, additional_parameters=None, playing_type=ACCOMPANIMENT_SUFFIX):
+        start = time.time()
+        try:
+            first_file, second_file, params = self.playlist_files(file_path, playing_type, additional_parameters)
+
+            self.start()
+            self.track += 1
+            track = self.track
+            self.track_file = file_path
+            self.clock = None
+            # command line options like --pitch-shift become per-input options
+            options, input_options = self.split_input_options(params)
+            options = [":%s=%s" % (name.lstrip("-"), value) for name, value in zip(options[::2], options[1::2])]
+            self.logger.debug("VLC playlist: %s %s" % (first_file, options + input_options))
+            self.command("pl_empty")
+            self.command("in_play&" + self.input_params(first_file, options + input_options))
+            if second_file and os.path.exists(second_file):
+                self.command("in_enqueue&" + self.input_params(second_file, options))
+
+            if self.wait_until_ready(["playing"]) is None:
+                self.logger.error("VLC did not start playing within %ss: %s" % (STARTUP_TIMEOUT, file_path))
+                self.end_track(track)
+                return
+            self.record_first_frame(file_path, start)
+            self.supervisor.watch(track)
+        except Exception as e:
+            self.logger.error("Playing file failed: " + str(e))
+            self.track_file = None
+
+    def is_multitrack(self, file_path):
+        """Whether a song is a single file with the accompaniment as first and the original
+        as second audio track, rather than an accompaniment/vocal pair of files."""
+        return (
+            os.path.splitext(file_path)[1].lower() == ".mkv"
+            and ACCOMPANIMENT_SUFFIX in file_path
+            and not os.path.exists(file_path.replace(ACCOMPANIMENT_SUFFIX, VOCAL_SUFFIX))
+        )
+
+    def playlist_files(self, file_path, playing_type, additional_parameters=None):
+        """(first file, second file, parameters): the file VLC starts with, the one queued
+        behind it to switch between vocal and accompaniment (None for multi-track files,
+        which are restarted on the other audio track instead) and the VLC parameters to
+        play them with."""
+        params = list(additional_parameters or [])
+        accompaniment_path = self.prepare_file(file_path)
+        self.track_multitrack = self.is_multitrack(file_path)
+        if self.track_multitrack:
+            if "--audio-track" not in params:
+                params += ["--audio-track", "1" if playing_type == VOCAL_SUFFIX else "0"]
+            return accompaniment_path, None, params
+        vocal_path = file_path.replace(ACCOMPANIMENT_SUFFIX, VOCAL_SUFFIX)
+        if vocal_path == file_path or not os.path.exists(vocal_path):
+            # not a separated pair, there is nothing to switch to
+            return accompaniment_path, None, params
+        if playing_type == ACCOMPANIMENT_SUFFIX:
+            return accompaniment_path, vocal_path, params
+        return vocal_path, accompaniment_path, params
+
+    def split_input_options(self, params):
+        """Split VLC parameters into the ones for every input and, as ":name=value" input
+        options, the ones that only make sense for the first: an audio track slaved to it
+        and the selection of an audio track by index."""
+        shared, input_options = [], []
+        for name, value in zip(params[::2], params[1::2]):
+            if name in INPUT_ONLY_OPTIONS:
+                input_options.append(":%s=%s" % (name.lstrip("-"), value))
+            else:
+                shared += [name, value]
+        return shared, input_options
+
+    def input_params(self, file_path, options=()):
+        params = "input=" + quote(file_path, safe="")
+        for option in options:
+            params += "&option=" + quote(option, safe="")
+        return params
+
+    def start(self):
+        """Start the persistent VLC instance, unless it is already running."""
+        if self.is_process_running():
+            return
+        if self.process is not None:
+            self.logger.warning("VLC exited unexpectedly, restarting it")
+        self.logger.debug("VLC Command: %s" % self.cmd_base)
+        self.process = subprocess.Popen(
+            self.cmd_base, shell=(self.platform == "windows"), stdin=subprocess.PIPE
+        )
+        watcher = threading.Thread(target=self.wait_process, args=[self.process])
+        watcher.daemon = True
+        watcher.start()
+        if self.wait_until_ready() is None:
+            self.logger.error("VLC http interface did not come up within %ss" % STARTUP_TIMEOUT)
+
+    def wait_until_ready(self, states=None, timeout=STARTUP_TIMEOUT):
+        """Poll status.xml with exponential backoff until VLC's http interface answers and,
+        with `states`, reports one of them. Returns the seconds waited, None on timeout or
+        if VLC exited meanwhile."""
+        start = time.time()
+        interval = PROBE_INTERVAL
+        while self.is_process_running():
+            try:
+                state = self.get_state(max_age=0)
+                if states is None or state["state"] in states:
+                    return time.time() - start
+            except Exception:
+                # http interface not up yet
+                pass
+            if time.time() - start + interval > timeout:
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, PROBE_MAX_INTERVAL)
+        return None
+
+    def record_first_frame(self, file_path, start):
+        elapsed = time.time() - start
+        self.first_frame_times.append(elapsed)
+        self.logger.info(
+            "Time to first frame: %.2fs (average %.2fs over the last %d songs): %s"
+            % (elapsed, sum(self.first_frame_times) / len(self.first_frame_times), len(self.first_frame_times), file_path)
+        )
+
+    def finish_track(self, track):
+        """Called by the supervisor when `track` played to its end."""
+        if track != self.track:
+            return
+        if self.persistent:
+            self.end_track(track)
+        else:
+            # with --play-and-exit, VLC would go on to play the vocal track
+            self.kill()
+
+    def end_track(self, track=None):
+        """Persistent mode: stop the current track and clear the playlist. `track` ends
+        a specific track only, if it is still the current one."""
+        if track is not None and track != self.track:
+            return
+        self.track += 1
+        was_playing = self.track_file is not None
+        self.track_file = None
+        if self.is_process_running():
+            try:
+                self.command("pl_stop")
+                self.command("pl_empty")
+            except Exception as e:
+                self.logger.warn("Could not clear VLC playlist: %s" % e)
+        if was_playing and self.on_exit:
+            self.on_exit()
+
+    def play_file_transpose(self, file_path, semitones, start_time=0, audio_path=None, playing_type=ACCOMPANIMENT_SUFFIX):
+        """Restart the song at `start_time`, shifted by `semitones`. With `audio_path`, a
+        pre-rendered shifted accompaniment is played over the video instead of shifting in
+        real time."""
         # --speex-resampler-quality=<integer [0 .. 10]>
         #  Resampling quality (0 = worst and fastest, 10 = best and slowest).
 
@@ -198,33 +432,62 @@ class VLCClient:
             speex_quality = 10
             src_type = 0
 
-        params = [
-            "--audio-filter",
-            "scaletempo_pitch",
-            "--pitch-shift",
-            "%s" % semitones,
-            "--speex-resampler-quality",
-            "%s" % speex_quality,
-            "--src-converter-type",
-            "%s" % src_type,
-        ]
+        if audio_path:
+            # the rendered track is added after the song's own audio tracks and selected
+            own_tracks = 2 if self.is_multitrack(file_path) else 1
+            params = ["--input-slave", audio_path, "--audio-track", "%d" % own_tracks]
+        elif semitones:
+            params = [
+                "--audio-filter",
+                "scaletempo_pitch",
+                "--pitch-shift",
+                "%s" % semitones,
+                "--speex-resampler-quality",
+                "%s" % speex_quality,
+                "--src-converter-type",
+                "%s" % src_type,
+            ]
+        else:
+            params = []
 
-        self.is_transposing = True
         self.logger.debug("Transposing file...")
-        self.play_file(file_path, params)
-
-        # Prevent is_running() from returning False while we're transposing
-        s = Timer(2.0, self.set_transposing_complete)
-        s.start()
+        if self.persistent:
+            # the track is swapped within the same VLC, is_running() never drops
+            return self.play_file(file_path, params, playing_type, start_time)
+        # Prevent is_running() from returning False while the old VLC exits and the new
+        # one starts, play_file() returns once the new one is playing
+        self.is_transposing = True
+        try:
+            self.play_file(file_path, params, playing_type, start_time)
+        finally:
+            self.set_transposing_complete()
 
     def set_transposing_complete(self):
         self.is_transposing = False
         self.logger.debug("Transposing complete")
+        # is_running() ignored the process while transposing, it may have ended meanwhile
+        if not self.is_running() and self.on_exit:
+            self.on_exit()
+
+    def wait_process(self, process):
+        process.wait()
+        self.logger.debug("VLC process exited with code %s" % process.returncode)
+        if self.persistent:
+            if process is not self.process:
+                return
+            # VLC crashed or was killed, it is restarted with the next song
+            self.track += 1
+            self.track_file = None
+        if self.on_exit:
+            self.on_exit()
 
     def command(self, command):
-        if self.is_running():
+        if self.is_process_running():
             url = self.http_command_endpoint + command
-            request = requests.get(url, auth=("", self.http_password))
+            # whatever the command changed, the cached status no longer shows it
+            self.invalidate_status()
+            request = self.session.get(url, timeout=HTTP_TIMEOUT)
+            self.invalidate_status()
             return request
         else:
             self.logger.error("No active VLC process. Could not run command: " + command)
@@ -236,6 +499,8 @@ class VLCClient:
         return self.command("pl_play")
 
     def stop(self):
+        if self.persistent:
+            return self.end_track()
         try:
             return self.command("pl_stop")
         except:
@@ -247,23 +512,27 @@ class VLCClient:
             return
 
     def add_song(self, file_url):
-        return self.command(f"in_enqueue&input={file_url}")
+        return self.command("in_enqueue&" + self.input_params(file_url))
 
     def switch_vocals_accompaniment(self):
-        seek_val = self.get_seek()
+        seek_val = self.get_position()
         self.command(f"pl_next")
         time.sleep(0.1)
         self.seek(seek_val)
 
     def seek(self, val=0):
-        return self.command(f"seek&val={val}")
+        request = self.command(f"seek&val={val}")
+        clock = self.clock
+        if clock:
+            self.clock = (int(val), time.monotonic(), clock[2], clock[3])
+        return request
 
     def fast_forward(self, seconds=7):
-        val = self.get_seek()
+        val = self.get_position()
         self.seek(int(val) + seconds)
 
     def fast_backward(self, seconds=7):
-        val = self.get_seek()
+        val = self.get_position()
         new_val = int(val) - seconds
         new_val = 0 if new_val < 0 else new_val
         self.seek(new_val)
@@ -276,8 +545,8 @@ class VLCClient:
         return seek
 
     def vol_up(self):
-        self.logger.error(self.get_volume(), self.volume_offset)
         current_volume = self.get_volume()
+        self.logger.debug("Volume up from %s by %s" % (current_volume, self.volume_offset))
         if current_volume + self.volume_offset < 250:
             return self.command("volume&val=%d" % (current_volume + self.volume_offset))
 
@@ -292,56 +561,96 @@ class VLCClient:
             print(e)
             return
 
+    def is_process_running(self):
+        return self.process != None and self.process.poll() == None
+
     def is_running(self):
-        return (
-                       self.process != None and self.process.poll() == None
-               ) or self.is_transposing
+        """Whether a track is playing (or paused)."""
+        if self.persistent:
+            return self.track_file != None and self.is_process_running()
+        return self.is_process_running() or self.is_transposing
 
     def is_playing(self):
         if self.is_running():
-            status = self.get_status()
-            state = status.find("state").text
-            return state == "playing"
+            return self.get_state()["state"] == "playing"
         else:
             return False
 
     def is_paused(self):
         if self.is_running():
-            status = self.get_status()
-            state = status.find("state").text
-            return state == "paused"
+            return self.get_state()["state"] == "paused"
         else:
             return False
 
     def get_volume(self):
-        status = self.get_status()
-        return int(status.find("volume").text)
+        return self.get_state()["volume"]
 
     def get_seek(self):
-        status = self.get_status()
-        return int(status.find("time").text)
+        return self.get_state()["time"]
 
     def get_length(self):
-        status = self.get_status()
-        return int(status.find("length").text)
-
-    def get_status(self):
-        url = self.http_endpoint
-        request = requests.get(url, auth=("", self.http_password))
-        return ET.fromstring(request.text)
-
-    def listen_status(self):
-        while self.is_playing():
-            try:
-                time.sleep(1)
-                length = self.get_length()
-                seek = self.get_seek()
-                if length and seek / length > 0.98:
-                    self.kill()
-                    break
-            except:
-                break
-        self.logger.debug('Listener thread exits.')
+        return self.get_state()["length"]
+
+    def get_position(self):
+        """Current playback position in seconds, interpolated from the last status sample
+        so that no status request is needed."""
+        clock = self.clock
+        if clock is None:
+            return self.get_seek()
+        position, sampled, state, length = clock
+        if state == "playing":
+            position += time.monotonic() - sampled
+            if length:
+                position = min(position, length)
+        return position
+
+    def get_duration(self):
+        clock = self.clock
+        return clock[3] if clock else self.get_length()
+
+    def update_clock(self, status):
+        state = status.find("state").text
+        length = int(status.find("length").text)
+        position = int(status.find("time").text)
+        try:
+            # <time> is whole seconds, <position> is the finer fraction of the length
+            if length:
+                position = float(status.find("position").text) * length
+        except (AttributeError, TypeError, ValueError):
+            pass
+        self.clock = (position, time.monotonic(), state, length)
+
+    def get_state(self, max_age=STATUS_TTL):
+        """State ("playing", "paused", "stopped"), time, length (both in seconds) and
+        volume, all from a single status.xml fetch."""
+        status = self.get_status(max_age)
+        return {
+            "state": status.find("state").text,
+            "time": int(status.find("time").text),
+            "length": int(status.find("length").text),
+            "volume": int(status.find("volume").text),
+        }
+
+    def get_status(self, max_age=STATUS_TTL):
+        """Parsed status.xml, reused for up to `max_age` seconds unless a command ran since."""
+        with self.status_lock:
+            if self.status is not None and time.time() - self.status_time < max_age:
+                return self.status
+            generation = self.status_generation
+        request = self.session.get(self.http_endpoint, timeout=HTTP_TIMEOUT)
+        status = ET.fromstring(request.text)
+        self.update_clock(status)
+        with self.status_lock:
+            # don't cache a status that was fetched while a command ran
+            if generation == self.status_generation:
+                self.status = status
+                self.status_time = time.time()
+        return status
+
+    def invalidate_status(self):
+        with self.status_lock:
+            self.status = None
+            self.status_generation += 1
 
     def run(self):
         try:
@@ -0,0 +1,101 @@
+"""Compare separating a long song in one go against separating it in overlapping pieces
+across worker processes.
+
+Builds a synthetic stereo track (a gliding, vibrato "voice" over chords and percussive
+noise) and separates it with SeparationService twice: with one worker and no segments,
+as spleeter used to, then in segments over all workers. Model loading is left out of the
+timings; the service logs the model time of each run against its total. The difference
+between the two accompaniments shows how much the crossfaded seams change the result.
+Needs ffmpeg, spleeter and its pretrained 2stems model.
+
+usage: python scripts/benchmark_separation.py [--minutes 15] [--workers N] [--segment 30]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import wave
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.separation_service import SAMPLE_RATE, SEGMENT_SECONDS, SeparationService
+
+
+def make_track(minutes, seed=42):
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(int(minutes * 60 * SAMPLE_RATE), dtype=numpy.float32) / SAMPLE_RATE
+    # voice: a melody moving every 2 seconds, with vibrato
+    notes = 220 * 2 ** (rng.integers(0, 12, size=int(t[-1] / 2) + 1) / 12)
+    pitch = notes[(t / 2).astype(int)] * (1 + 0.01 * numpy.sin(2 * numpy.pi * 5 * t))
+    voice = 0.3 * numpy.sin(2 * numpy.pi * numpy.cumsum(pitch) / SAMPLE_RATE)
+    # accompaniment: a chord changing every 8 seconds and a noise hit on every beat
+    roots = 110 * 2 ** (rng.integers(0, 12, size=int(t[-1] / 8) + 1) / 12)
+    root = roots[(t / 8).astype(int)]
+    chord = sum(0.1 * numpy.sin(2 * numpy.pi * root * ratio * t) for ratio in (1, 1.25, 1.5))
+    beat = numpy.exp(-30 * (t % 0.5)) * rng.standard_normal(len(t)).astype(numpy.float32) * 0.2
+    left, right = voice + chord + beat, voice + 0.8 * chord + 1.2 * beat
+    return numpy.stack([left, right], axis=1).astype(numpy.float32)
+
+
+def write_wav(path, track):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((numpy.clip(track, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as f:
+        return numpy.frombuffer(f.readframes(f.getnframes()), dtype="<i2").reshape(-1, 2) / 32767.0
+
+
+def run(song_path, output_path, workers, segment):
+    service = SeparationService(workers=workers, logger=logging.getLogger())
+    service.start()
+    while service.ready < service.workers:
+        time.sleep(0.1)
+    start = time.time()
+    ok = service.separate(song_path, output_path, segment=segment)
+    wall = time.time() - start
+    service.stop()
+    if not ok:
+        sys.exit("separation failed")
+    return read_wav(os.path.join(output_path, "accompaniment.wav")), wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-shot vs chunked separation")
+    parser.add_argument("--minutes", type=float, default=15, help="Length of the synthetic track")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Workers for the chunked run")
+    parser.add_argument("--segment", type=int, default=SEGMENT_SECONDS, help="Segment length in seconds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tmp_path = tempfile.mkdtemp()
+    try:
+        song_path = os.path.join(tmp_path, "synthetic.wav")
+        write_wav(song_path, make_track(args.minutes))
+        print("synthetic track: %.1f minutes" % args.minutes)
+
+        single, single_wall = run(song_path, tmp_path, 1, 0)
+        print("single-shot: %.2fs" % single_wall)
+        chunked, chunked_wall = run(song_path, tmp_path, args.workers, args.segment)
+        print("chunked:     %.2fs (%d workers, %ds segments)" % (chunked_wall, args.workers, args.segment))
+        print("speedup: %.2fx" % (single_wall / chunked_wall))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    assert len(single) == len(chunked), "chunked output length differs from the single-shot one"
+    difference = numpy.sqrt(numpy.mean((single - chunked) ** 2))
+    level = numpy.sqrt(numpy.mean(single ** 2))
+    print("difference to single-shot: %.1f dB below the accompaniment" % (20 * numpy.log10(level / max(difference, 1e-12))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Measure the memory held by the in-memory song catalog, per 10k songs.
+
+Builds a synthetic library (titles with a youtube id, spread over a few hundred
+directories) and reports what tracemalloc still sees allocated once the rows used to
+build the catalog are dropped. The plain list of absolute paths that
+Karaoke.available_songs used to be is measured as a baseline.
+
+usage: python scripts/measure_catalog_memory.py [number of songs]
+"""
+import gc
+import os
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import *
+from lib.normalize import normalize_key
+from lib.song_catalog import SongCatalog
+
+WORDS = [
+    "love", "night", "heart", "dance", "baby", "dream", "fire", "rain", "summer", "girl",
+    "beyoncé", "queen", "road", "home", "light", "star", "blue", "crazy", "forever", "time",
+]
+
+
+def make_paths(count, root="/media/karaoke/songs"):
+    rng = random.Random(42)
+    paths = []
+    for i in range(count):
+        artist = " ".join(rng.choice(WORDS).title() for _ in range(2))
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        youtube_id = "".join(rng.choice(string.ascii_letters + string.digits + "-_") for _ in range(11))
+        directory = "%s/disk%d/%s" % (root, i % 4, artist)
+        paths.append(
+            "%s/%s - %s (Karaoke Version)---%s%s.mp4" % (directory, artist, title, youtube_id, ACCOMPANIMENT_SUFFIX)
+        )
+    return paths
+
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    result = build(count)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def build_path_list(count):
+    return make_paths(count)
+
+
+def build_catalog(count):
+    paths = make_paths(count)
+    rows = [(path, normalize_key(os.path.basename(path).split("---")[0]), 1600000000.0 + i) for i, path in enumerate(paths)]
+    catalog = SongCatalog()
+    catalog.update(rows, [])
+    catalog.update_files(paths, [])
+    return catalog
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    # load the zhconv dictionary up front so it isn't counted as catalog memory
+    normalize_key("")
+    for name, build in (("path list (baseline)", build_path_list), ("song catalog", build_catalog)):
+        size = measure(build, count)
+        print("%-22s %8.1f MiB total, %6.2f MiB per 10k songs" % (name, size / 2 ** 20, size / 2 ** 20 * 10000 / count))
@@ -0,0 +1,89 @@
+"""Convert separated songs stored as two files into single multi-track files.
+
+Songs separated before --multitrack are stored as an accompaniment/vocal pair, two full
+copies of the same video. Each pair found under the given directories is remuxed (stream
+copy, nothing is re-encoded) into one .mkv holding the video once, the accompaniment as
+first and the original audio as second audio track. The pair is deleted once the new
+file is written, unless --keep-originals is given.
+
+usage: python scripts/migrate_multitrack.py [--dry-run] [--keep-originals] directory...
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import *
+from lib.cache_files import PARTIAL_SUFFIX
+
+
+def find_pairs(directory):
+    for dir_path, dir_names, file_names in os.walk(directory):
+        for name in sorted(file_names):
+            base, ext = os.path.splitext(name)
+            if not base.endswith(ACCOMPANIMENT_SUFFIX) or ext.lower() == ".zip":
+                continue
+            vocal_name = base[: -len(ACCOMPANIMENT_SUFFIX)] + VOCAL_SUFFIX + ext
+            if vocal_name in file_names:
+                yield os.path.join(dir_path, name), os.path.join(dir_path, vocal_name)
+
+
+def migrate(accompaniment_path, vocal_path, keep_originals=False):
+    """Remux a pair into one file, returns the path of the multi-track file."""
+    base = os.path.splitext(accompaniment_path)[0]
+    out_path = base + ".mkv"
+    partial_path = base + PARTIAL_SUFFIX + ".mkv"
+    if keep_originals and out_path == accompaniment_path:
+        raise RuntimeError("the accompaniment is an .mkv already, it can't be kept")
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", vocal_path, "-i", accompaniment_path,
+        "-map", "0:v:0", "-map", "1:a:0", "-map", "0:a:0", "-c", "copy",
+        "-metadata:s:a:0", "title=Accompaniment", "-metadata:s:a:1", "title=Vocal",
+        "-disposition:a:0", "default", "-disposition:a:1", "0",
+        partial_path,
+    ]
+    if subprocess.call(cmd) != 0:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise RuntimeError("ffmpeg failed")
+    # in place before the pair goes away, so a song is never left with neither version
+    os.replace(partial_path, out_path)
+    if not keep_originals:
+        os.remove(vocal_path)
+        if accompaniment_path != out_path:
+            os.remove(accompaniment_path)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert accompaniment/vocal pairs into multi-track .mkv files")
+    parser.add_argument("directories", nargs="+", help="Song directories, searched recursively")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the pairs that would be converted")
+    parser.add_argument("--keep-originals", action="store_true", help="Don't delete the pairs once converted")
+    args = parser.parse_args()
+
+    converted = failed = saved = 0
+    for directory in args.directories:
+        for accompaniment_path, vocal_path in find_pairs(directory):
+            if args.dry_run:
+                print(accompaniment_path)
+                continue
+            before = os.path.getsize(accompaniment_path) + os.path.getsize(vocal_path)
+            try:
+                out_path = migrate(accompaniment_path, vocal_path, args.keep_originals)
+            except (OSError, RuntimeError) as e:
+                print("failed: %s: %s" % (accompaniment_path, e))
+                failed += 1
+                continue
+            saved += before - os.path.getsize(out_path)
+            converted += 1
+            print("converted: %s" % out_path)
+
+    if not args.dry_run:
+        print("%d converted, %d failed, %.1f MB saved" % (converted, failed, saved / 1e6))
+
+
+if __name__ == "__main__":
+    main()